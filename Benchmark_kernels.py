@@ -0,0 +1,202 @@
+'''
+Microbenchmark of the alignment kernels of EpiAlignment_3.py.
+
+Synthetic region pairs are generated over a grid of query lengths, target
+lengths and numbers of epi marks, and aligned by each kernel backend in a
+fresh process. For each grid point and kernel, the cells per second, the
+latency per pair and the peak resident memory of the process are reported
+and written to a JSON file, which can be compared against a baseline from
+an earlier run.
+
+Usage: python3 Benchmark_kernels.py -o results.json [--baseline old.json]
+'''
+import argparse
+import json
+import platform
+import random
+import resource
+import sys
+import time
+from array import array
+from math import log
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import EpiAlignment_3 as ea
+
+
+def ParseArg():
+    p = argparse.ArgumentParser(
+        description="Benchmark the alignment kernels on synthetic pairs.")
+    p.add_argument("-q", "--query_len", type=int, nargs="+",
+                   default=[100, 300], help="Query lengths. Default: 100 300.")
+    p.add_argument("-t", "--target_len", type=int, nargs="+",
+                   default=[1000, 3000], help="Target lengths. Default: " +
+                   "1000 3000.")
+    p.add_argument("-m", "--marks", type=int, nargs="+", default=[1, 2],
+                   help="Numbers of epi marks. Default: 1 2.")
+    p.add_argument("-k", "--kernel", type=str, nargs="+",
+                   default=["python", "numpy", "batch"], help="Kernel " +
+                   "backends (see -k of EpiAlignment_3.py). Default: python " +
+                   "numpy batch.")
+    p.add_argument("-n", "--pairs", type=int, default=4, help="Region pairs " +
+                   "per grid point. Default: 4.")
+    p.add_argument("-r", "--repeat", type=int, default=3, help="Number of " +
+                   "timed runs; the fastest is reported. Default: 3.")
+    p.add_argument("--precision", type=str, choices=ea.PRECISIONS,
+                   default="float64", help="Number type of the numpy " +
+                   "kernels. Default: float64.")
+    p.add_argument("-o", "--output", type=str, required=True, help="JSON " +
+                   "file of the results.")
+    p.add_argument("--baseline", type=str, help="JSON file of an earlier " +
+                   "run. Grid points that are slower by more than " +
+                   "--threshold are reported, and the exit code is 1.")
+    p.add_argument("--threshold", type=float, default=0.1, help="Allowed " +
+                   "relative loss of cells per second against the " +
+                   "baseline. Default: 0.1.")
+    return p.parse_args()
+
+
+def Synthetic_model(n_epi):
+    '''
+    Model parameters for n_epi marks, in the form returned by
+        ea.ReadParameters.
+    '''
+    x = [0.1, 0.2] + [0.3] * n_epi
+    weights = [1.0] + [0.1] * n_epi
+    equil_dict = {"A": 0.25, "C": 0.25, "G": 0.25, "T": 0.25}
+    for k in range(1, n_epi + 1):
+        equil_dict[k] = [0.8, 0.2]
+    log_equil_dict = {}
+    for key, value in equil_dict.items():
+        if isinstance(value, list):
+            log_equil_dict[key] = [log(f) for f in value]
+        else:
+            log_equil_dict[key] = log(value)
+    return x, weights, equil_dict, log_equil_dict
+
+
+def Synthetic_pairs(count, query_len, target_len, n_epi, seed=0):
+    '''
+    Region pairs with a random target and a query copied from part of it
+        with 15% substitutions, with random epi-states.
+    '''
+    rng = random.Random(seed)
+    typecode = ea.Epi_typecode(n_epi)
+    pairs = []
+    for k in range(count):
+        target = [rng.randrange(4) for j in range(target_len)]
+        start = rng.randrange(max(1, target_len - query_len + 1))
+        query = [b if rng.random() >= 0.15 else rng.randrange(4)
+                 for b in target[start:start + query_len]]
+        query += [rng.randrange(4) for i in range(query_len - len(query))]
+        S = ea.HomoRegion()
+        S.name = "pair_" + str(k)
+        S.n_epi = n_epi
+        S.S1 = array("B", query)
+        S.S2 = array("B", target)
+        S.S1_epi = array(typecode, [rng.randrange(1 << n_epi)
+                                    for i in range(query_len)])
+        S.S2_epi = array(typecode, [rng.randrange(1 << n_epi)
+                                    for j in range(target_len)])
+        pairs.append(S)
+    return pairs
+
+
+def Bench_point(point):
+    '''
+    Time one kernel on one grid point. Run in a fresh process, so that the
+        peak memory is that of this grid point only.
+    point: (kernel, query_len, target_len, n_epi, pairs, repeat, precision)
+    return: a dictionary of the measurements.
+    '''
+    kernel, query_len, target_len, n_epi, count, repeat, precision = point
+    S = Synthetic_pairs(count, query_len, target_len, n_epi)
+    param = {'kernel': kernel, 'precision': precision, 'band': None,
+             'prefilter': False, 'all_prob': None, 'align_path': None,
+             'hit_summary': False, 'batch_size': count}
+    ea.Model_param(param, Synthetic_model(n_epi), n_epi, query_len,
+                   target_len)
+    align = ea.Kernel_backend(kernel)
+    best = None
+    for r in range(repeat):
+        t0 = time.perf_counter()
+        if kernel == "batch":
+            ea.Manhattan_batch(S, param)
+        else:
+            for pair in S:
+                align(pair, [param])
+        seconds = time.perf_counter() - t0
+        best = seconds if best is None else min(best, seconds)
+    cells = count * query_len * target_len
+    return {
+        "kernel": kernel,
+        "query_len": query_len,
+        "target_len": target_len,
+        "marks": n_epi,
+        "pairs": count,
+        "cells": cells,
+        "seconds": best,
+        "cells_per_s": cells / best,
+        "latency_ms": 1000.0 * best / count,
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+        (1 << 20 if sys.platform == "darwin" else 1 << 10),
+    }
+
+
+def Point_key(result):
+    return (result["kernel"], result["query_len"], result["target_len"],
+            result["marks"])
+
+
+def Compare(results, baseline, threshold):
+    '''
+    Print the speed of each grid point relative to the baseline.
+    return: the number of grid points slower than the baseline by more
+        than threshold.
+    '''
+    base = {Point_key(r): r for r in baseline["results"]}
+    slower = 0
+    for r in results:
+        b = base.get(Point_key(r))
+        if b is None:
+            continue
+        ratio = r["cells_per_s"] / b["cells_per_s"]
+        flag = ""
+        if ratio < 1 - threshold:
+            flag = "\tSLOWER"
+            slower += 1
+        print("%s\tq=%d\tt=%d\tmarks=%d\t%.3fx%s" %
+              (Point_key(r) + (ratio, flag)))
+    return slower
+
+
+def Main():
+    args = ParseArg()
+    points = [(kernel, q, t, n_epi, args.pairs, args.repeat, args.precision)
+              for n_epi in args.marks for q in args.query_len
+              for t in args.target_len for kernel in args.kernel]
+    results = []
+    for point in points:
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as ex:
+            r = ex.submit(Bench_point, point).result()
+        results.append(r)
+        print("%s\tq=%d\tt=%d\tmarks=%d\t%.3g cells/s\t%.2f ms/pair\t"
+              "%.1f MB" % (Point_key(r) + (r["cells_per_s"], r["latency_ms"],
+                                           r["peak_rss_mb"])))
+    machine = {"python": platform.python_version(),
+               "numpy": ea.np.__version__ if ea.np is not None else None,
+               "machine": platform.machine(),
+               "system": platform.system()}
+    with open(args.output, "w") as fout:
+        json.dump({"machine": machine, "results": results}, fout, indent=1)
+    if args.baseline:
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)
+        if Compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    Main()
@@ -2,20 +2,87 @@
 
 import argparse
 import sys
+import os
+import io
 import copy
 import math
+import time
+import itertools
+import json
+import pickle
+import queue
+import hashlib
+import importlib
+import random
+import signal
+import socket
+import tempfile
+from contextlib import redirect_stderr
+from array import array
 from math import log, exp
 from multiprocessing import get_context
+from ScoreVectors import VectorWriter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Kernel backends by name, added by Register_kernel. python is the reference
+# implementation, against which Conformance checks the others.
+KERNELS = {}
+# Number types of the scores in the numpy kernels.
+PRECISIONS = ("float64", "float32", "fixed")
+# In the fixed-point mode, scores are int32 multiples of 1 / FIXED_SCALE,
+# and -Inf is FIXED_NA. Values below FIXED_NA / 2 are read back as -Inf.
+FIXED_SCALE = 1024
+FIXED_NA = -(1 << 30)
+# Half-width of the windows of Hit_summary around the hits of the other
+# parameter sets, and size of the bins of its signal-to-noise bounds.
+HIT_WINDOW = 50
+NOISE_BIN = 500
+# Up to this many epi marks, the diagonal-move scores of all pairs of symbols
+# are tabulated (Pair_score_table). With more marks, the table would have
+# (4 * 2^n_epi)^2 entries, and the scores are computed from per-mark terms
+# instead (EpiFactors).
+EPI_DENSE_MARKS = 6
+# Added to and subtracted from a running sum of scores, it leaves 0 (see
+# Gap_scores).
+GAP_FLUSH = 2.0 ** 100
+# Fraction of --cache_size to which PairCache evicts when a run exceeds it.
+CACHE_LOW_WATER = 0.9
+
+
+BASES = "ACGT"
+# Translation table from DNA bases to base codes (A, C, G, T -> 0, 1, 2, 3).
+# Other characters are mapped to 255.
+BASE_TABLE = bytes(BASES.index(chr(c)) if chr(c) in BASES else 255
+                   for c in range(256))
 
 
 class HomoRegion:
     '''
     class of homologous regions.
+    S1, S2: base codes of the two regions (array of unsigned char).
+    S1_epi, S2_epi: epi-states of the two regions. Each state is a bitmask,
+        in which the first epi mark is the most significant bit, so that
+        the state '01' is stored as 1 and '10' as 2.
+    n_epi: number of epigenomic marks.
+    diag: the expected offset of S1 in S2, if given in the input header
+        (diag=<offset>). Used by the banded alignment.
     '''
+    __slots__ = ("S1", "S2", "S1_epi", "S2_epi", "n_epi", "L", "name",
+                 "averagedL", "loc2", "loc1", "start_point", "prob",
+                 "S1_path", "S2_path", "S_match", "S1_epi_path",
+                 "S2_epi_path", "diag", "band_edge", "cells", "seeds",
+                 "windows", "summary")
 
     def __init__(self):
-        self.S1 = []
-        self.S2 = []
+        self.S1 = array("B")
+        self.S2 = array("B")
+        self.S1_epi = array("B")
+        self.S2_epi = array("B")
+        self.n_epi = 0
         self.L = 0
         self.name = ""
         self.averagedL = 0
@@ -25,38 +92,298 @@ class HomoRegion:
         self.prob = []
         self.S1_path = ""
         self.S2_path = ""
+        self.S_match = ""
+        self.S1_epi_path = {}
+        self.S2_epi_path = {}
+        self.diag = None
+        self.band_edge = None
+        self.cells = 0
+        self.seeds = 0
+        self.windows = 0
+        self.summary = []
+
+
+def Epi_typecode(n_epi):
+    '''
+    The smallest array typecode that can hold the bitmasks of n_epi marks.
+    '''
+    if n_epi <= 8:
+        return "B"
+    elif n_epi <= 16:
+        return "H"
+    return "L"
+
+
+def Epi_string(state, n_epi):
+    '''
+    Convert an epi-state bitmask back to a string of '1's and '0's.
+    '''
+    return bin(state)[2:].zfill(n_epi)
 
 
-def ParseArg():
+def ParseArg(argv=None):
     p = argparse.ArgumentParser(
         description="EpiAlignment. A semi-global alignment algorithm " +
         "for chromosomal similarity search.")
-    p.add_argument("Input", type=str, help="Input file name.")
+    p.add_argument("Input", type=str, nargs="?", help="Input file name.")
     p.add_argument(
         "-e",
         "--equil_file",
         type=str,
+        action="append",
         help="The parameter file containing intial guesses for s, mu, k, " +
-        "equilibrium probabilities and weights.")
+        "equilibrium probabilities and weights. May be given several " +
+        "times to align the input with several parameter sets in one " +
+        "run, e.g. with and without epigenomic weights. Each parameter " +
+        "file needs its own -o (and -O, -r) file, given in the same order.")
     p.add_argument("-p", "--process_num", type=int, default=1, help="Number " +
                    "of processes to be used. Default: 1.")
     p.add_argument(
         "-o",
         "--output",
         type=str,
+        action="append",
         help="Output file name. This file contains region name, alignment " +
         "scores and target position for each region pair.")
     p.add_argument(
         "-O",
         "--out_allvec",
         type=str,
+        action="append",
         help="Output file name. This file contains the last rows of the " +
         "alignment matrices (alignment scores across the search regions). " +
         "Only available when --all_prob is specified.")
-    if len(sys.argv) == 1:
+    p.add_argument(
+        "--hit_summary",
+        action="store_true",
+        help="Append summaries of the score vectors to the output lines: " +
+        "for each other parameter set, the maximal score within " +
+        str(HIT_WINDOW) + " positions of its hit, and the upper and lower " +
+        "signal-to-noise bounds (see Hit_summary). The score vectors are " +
+        "computed, but only written with -O.")
+    p.add_argument(
+        "--vec_format",
+        type=str,
+        choices=("text", "binary"),
+        default="text",
+        help="Format of the -O files. text: one line per region pair, with " +
+        "the name and the scores separated by commas. binary: float32 " +
+        "vectors with an offset table, read with ScoreVectors.py, which " +
+        "also converts them to text. Default: text.")
+    p.add_argument(
+        "-k",
+        "--kernel",
+        type=str,
+        default=os.environ.get("EPIALIGNMENT_KERNEL", "python"),
+        help="The implementation used to fill the alignment matrices. " +
+        "python: the reference implementation. numpy: row-vectorized " +
+        "implementation (requires numpy). batch: numpy implementation " +
+        "aligning batches of pairs with similar lengths in lockstep, for " +
+        "many short pairs. module:function: a function of an importable " +
+        "module that fills the matrices of a region pair like Manhattan " +
+        "(see Kernel_backend). Default: the EPIALIGNMENT_KERNEL " +
+        "environment variable, or python.")
+    p.add_argument(
+        "--conformance",
+        type=int,
+        nargs="?",
+        const=100,
+        help="Instead of the alignment, check the kernel (-k) against the " +
+        "python kernel on the input region pairs and on this many " +
+        "generated pairs (default: 100). The scores and positions of both " +
+        "are written to the output file (-o). Fails if a score differs by " +
+        "more than --tolerance, or if a position differs and its score in " +
+        "the python kernel is more than --tolerance below the best.")
+    p.add_argument("--tolerance", type=float, default=1e-6, help="Maximal " +
+                   "score difference allowed by --conformance. Default: " +
+                   "1e-6.")
+    p.add_argument(
+        "--precision",
+        type=str,
+        choices=PRECISIONS,
+        default="float64",
+        help="Number type of the scores in the numpy and batch kernels. " +
+        "float32 and fixed (int32 in units of 1/" + str(FIXED_SCALE) +
+        ") halve the memory traffic of float64 at the cost of rounding " +
+        "errors; pairs too long for fixed are computed in float64. Use " +
+        "--check_precision to measure the errors on your data. " +
+        "Default: float64.")
+    p.add_argument(
+        "--check_precision",
+        type=int,
+        nargs="?",
+        const=100,
+        help="Instead of the alignment, compare --precision with float64 " +
+        "on a sample of this many region pairs (default: 100), evenly " +
+        "spread over the input. The scores and positions of both are " +
+        "written to the output file (-o), and the maximal score difference " +
+        "and the number of pairs whose positions changed are reported.")
+    p.add_argument("-b", "--batch_size", type=int, default=64, help="Number " +
+                   "of region pairs aligned together by the batch kernel. " +
+                   "Default: 64.")
+    p.add_argument("--window", type=int, default=1000, help="Number of " +
+                   "results held in memory for writing in the input order. " +
+                   "Region pairs are dispatched from the most to the least " +
+                   "expensive over the whole input while fewer results " +
+                   "than this wait for the pairs before them, and in the " +
+                   "input order otherwise. Batches of the batch kernel " +
+                   "are made from this many consecutive pairs. " +
+                   "Default: 1000.")
+    p.add_argument(
+        "--band",
+        type=int,
+        help="Half-width of the band for banded alignment. Region pairs " +
+        "with an expected diagonal in the input header (diag=<offset of " +
+        "the first region in the second region>) are only aligned within " +
+        "this distance of the diagonal, using the numpy kernel. Other " +
+        "pairs are aligned in full. A column is added to the output, " +
+        "which is 1 if the best alignment touched the edge of the band " +
+        "(a wider band may give a better score), 0 if not and . for pairs " +
+        "aligned in full.")
+    p.add_argument(
+        "--prefilter",
+        type=str,
+        nargs="?",
+        const="",
+        help="Only align the parts of the search regions around exact " +
+        "k-mer seeds whose epi-states mostly agree, using banded " +
+        "alignment with the numpy kernel. Pairs without seeds are aligned " +
+        "in full. The scores of skipped cells are -Inf. If a file name is " +
+        "given, the numbers of seeds, bands and computed cells of each " +
+        "pair are written to it.")
+    p.add_argument(
+        "-r",
+        "--align_path",
+        type=str,
+        action="append",
+        help="Alignment path file name. The alignment path will be output " +
+        "if specified. The paths are traced back with 2 bits per cell of " +
+        "the alignment matrix, and matrices larger than --path_cells are " +
+        "recomputed block by block to bound the memory.")
+    p.add_argument("--path_cells", type=int, default=100000000,
+                   help="Maximal number of cells of which the moves are " +
+                   "kept in memory at once when tracing back alignment " +
+                   "paths. " +
+                   "Default: 100000000 (25 MB).")
+    p.add_argument("--seed_k", type=int, default=12, help="Seed length " +
+                   "of --prefilter. Default: 12.")
+    p.add_argument("--seed_margin", type=int, default=100, help="Number of " +
+                   "cells aligned on both sides of the seed diagonals with " +
+                   "--prefilter. Default: 100.")
+    p.add_argument("--seed_windows", type=int, default=4, help="Maximal " +
+                   "number of bands aligned per pair with --prefilter. " +
+                   "Default: 4.")
+    p.add_argument("--seed_max_occ", type=int, default=16, help="K-mers " +
+                   "occurring more often than this in either region are " +
+                   "not used as seeds by --prefilter. Default: 16.")
+    p.add_argument(
+        "--worker_stats",
+        type=str,
+        nargs="?",
+        const="",
+        help="Report the utilization of the worker processes. If a file " +
+        "name is given, the number of jobs, the estimated cost (cells) " +
+        "and the busy time of each worker are written to it.")
+    p.add_argument(
+        "--pair_stats",
+        type=str,
+        nargs="?",
+        const="",
+        help="Report the cells per second of the run and the slowest " +
+        "region pairs, and write one JSON line per pair (size, cells, " +
+        "time, queue wait and worker) to this file. Default file: the " +
+        "output file (-o) followed by .pairs.jsonl.")
+    p.add_argument(
+        "--sweep",
+        type=str,
+        help="Parameter grid file. Each line is a parameter name and a " +
+        "comma-separated list of values: s, mu, k (the kappas of all epi " +
+        "marks) or k1, k2, ... (the kappa of one epi mark). The input is " +
+        "aligned with every combination of the values, the other " +
+        "parameters being taken from the parameter file (-e), using the " +
+        "numpy kernel with all combinations in one traversal of each " +
+        "pair. The output file (-o) is a table with the scores and target " +
+        "positions of each pair for each combination.")
+    p.add_argument(
+        "--checkpoint",
+        type=str,
+        nargs="?",
+        const="",
+        help="Save the results of the finished region pairs to this file " +
+        "(default: the first output file name + .checkpoint) while the " +
+        "alignment runs, so that an interrupted run can be resumed with " +
+        "--resume. The file is removed when the run is complete.")
+    p.add_argument("--checkpoint_interval", type=float, default=60,
+                   help="Seconds between two writes of the checkpoint " +
+                   "file to disk. Default: 60.")
+    p.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted run from its checkpoint file (see " +
+        "--checkpoint): the region pairs saved there are not aligned " +
+        "again. The checkpoint is only used if the input, the parameter " +
+        "files and the options are the same.")
+    p.add_argument(
+        "--cache",
+        type=str,
+        help="Directory of a result cache shared across runs. Region pairs " +
+        "already aligned with the same sequences, epi-states and " +
+        "parameters (including score vectors or paths, if requested) are " +
+        "read from the cache instead of being aligned again.")
+    p.add_argument("--cache_size", type=float, default=1024, help="Maximal " +
+                   "size of the result cache in MB. The least recently " +
+                   "used entries are removed at the end of each run. " +
+                   "Default: 1024.")
+    p.add_argument(
+        "--serve",
+        type=str,
+        help="Run as a service listening on this Unix socket, with a pool " +
+        "of --process_num worker processes that is kept between runs. " +
+        "Input and the other options are ignored; they are given by each " +
+        "run sent to the service with --server.")
+    p.add_argument(
+        "--server",
+        type=str,
+        help="Send this run to the service listening on this Unix socket " +
+        "(see --serve) instead of starting worker processes. The pool of " +
+        "the service is used, whatever --process_num is. If the service " +
+        "cannot be reached, the run is done locally.")
+    if argv is None and len(sys.argv) == 1:
         print(p.print_help(), file=sys.stderr)
         sys.exit(0)
-    return p.parse_args()
+    args = p.parse_args(argv)
+    if args.serve is None and args.Input is None:
+        p.error("the following arguments are required: Input")
+    return args
+
+
+def Encode_seq(line):
+    '''
+    Convert a line of DNA bases to base codes.
+    return: an array of unsigned char.
+    '''
+    codes = line.upper().encode().translate(BASE_TABLE)
+    if 255 in codes:
+        raise Exception(304,
+                        "Input sequences can only contain A, C, G and T."
+                        )
+    return array("B", codes)
+
+
+def Parse_header(Sobj, line):
+    '''
+    Parse a header line: @name [key=value ...]. The only key recognized is
+        diag, the expected offset of the first region in the second region.
+    '''
+    fields = line[1:].split()
+    Sobj.name = fields[0] if fields else ""
+    for field in fields[1:]:
+        key, _, value = field.partition("=")
+        if key == "diag":
+            try:
+                Sobj.diag = int(value)
+            except ValueError:
+                raise Exception(305, "Invalid diag in header: " + line)
 
 
 def ReadInput(fin_name):
@@ -70,7 +397,9 @@ def ReadInput(fin_name):
     s2_count = 0
     flag = 0
     with open(fin_name, "r") as fin:
-        S = []
+        S = array("B")
+        E = []
+        n_epi = 0
         s1_maxlen = 0
         s2_maxlen = 0
         s1_avelen = 0
@@ -88,6 +417,7 @@ def ReadInput(fin_name):
             if len(line) == 0:
                 if s1_count > s2_count:
                     Sobj.S2 = S
+                    Sobj.S2_epi = array(Epi_typecode(n_epi), E)
                     Slist.append(Sobj)
                     s2_count += 1
                     if len(Sobj.S1) > s1_maxlen:
@@ -104,10 +434,12 @@ def ReadInput(fin_name):
             if line == "+":
                 i = 0
                 flag = 0
+                n_epi += 1
                 continue
             if "@" in line:
                 if s1_count > s2_count:
                     Sobj.S2 = S
+                    Sobj.S2_epi = array(Epi_typecode(n_epi), E)
                     Slist.append(Sobj)
                     s2_count += 1
                     if len(Sobj.S1) > s1_maxlen:
@@ -118,21 +450,27 @@ def ReadInput(fin_name):
                     s2_avelen += len(Sobj.S2)
                 else:
                     Sobj = HomoRegion()
-                    Sobj.name = line[1:]
+                    Parse_header(Sobj, line)
                     Sobj.S1 = S
+                    Sobj.S1_epi = array(Epi_typecode(n_epi), E)
+                    Sobj.n_epi = n_epi
                     s1_count += 1
                 flag = 1
-                S = []
+                S = array("B")
+                E = []
+                n_epi = 0
                 continue
             if flag == 1:
-                line = line.upper()
-                S += [(x, "") for x in line]
+                S += Encode_seq(line)
+                E = [0] * len(S)
             else:
-                S = S[0:i] + [
-                    (a[0], a[1] + b) for a, b in zip(
-                        S[i:(i + len(line))], line
+                # Each "+" block adds one epi mark (a lower bit) to every
+                # position.
+                E[i:(i + len(line))] = [
+                    (e << 1) | (b == "1") for e, b in zip(
+                        E[i:(i + len(line))], line
                     )
-                ] + S[(i + len(line)):]
+                ]
                 i += len(line)
     return Slist, s1_maxlen, s2_maxlen, s1_avelen / len(Slist), \
         s2_avelen / len(Slist)
@@ -189,6 +527,42 @@ def ReadParameters(f_name):
                 x.append(float(line[0]))
     return x, weights, equil_dict, log_equil_dict
 
+
+def ReadSweep(f_name, n_epi):
+    '''
+    Read the parameter grid of --sweep.
+    f_name: grid file name. Each line is a parameter name and a
+        comma-separated list of values, e.g. "mu\t0.1,0.2,0.3".
+    n_epi: number of epi marks.
+    return: a list of (name, indices in the parameter vector x, values).
+    '''
+    axes = []
+    with open(f_name, "r") as fin:
+        for line in fin:
+            line = line.strip().split()
+            if len(line) == 0:
+                continue
+            name = line[0]
+            if name == "s":
+                indices = [0]
+            elif name == "mu":
+                indices = [1]
+            elif name == "k":
+                indices = list(range(2, n_epi + 2))
+            elif name[0] == "k" and name[1:].isdigit() and \
+                    1 <= int(name[1:]) <= n_epi:
+                indices = [1 + int(name[1:])]
+            else:
+                raise Exception(303, "Unknown parameter in the sweep " +
+                                "file: " + name)
+            try:
+                values = [float(v) for v in "".join(line[1:]).split(",")]
+            except ValueError:
+                raise Exception(303, "Invalid values of " + name +
+                                " in the sweep file.")
+            axes.append((name, indices, values))
+    return axes
+
 # def Log_sum(lnA, lnB, lnC, lnD):
 #   '''
 #   tmp=[logA, logB, logC, logD]
@@ -452,6 +826,227 @@ def Combine_epi_trans(log_trans_dic, log_S_epi):
     return log_trans_prod
 
 
+def Pair_score_table(n_epi, param):
+    '''
+    Precompute the part of the diagonal-move score of every pair of symbols
+        that comes before the score of the previous cell, so that the inner
+        loop of the dynamic programming only needs one lookup per cell.
+        The diagonal move is then
+        table[sym1][sym2] + manh3 - log_equil_mat[sym2] - diag_norm, summed
+        in this order as in the original implementation, so that the scores
+        and the positions of the alignments do not change in the last bits.
+    A symbol combines a base and an epi-state: base code * 2^n_epi + epi
+        bitmask (see Encode_symbols).
+    n_epi: number of epi marks.
+    param: the parameter dictionary with Log_transition_dic, Log_trans_prod,
+        log_equil_mat, log_link_p and log_lamb_mu.
+    return: a list of lists. table[sym1][sym2] is
+        log_lamb_mu + max(tmp0, tmp1), where
+        tmp0 = f(base1, base2) + log p_1 + g(epi1, epi2) and
+        tmp1 = log p'_1 + log_equil_mat[sym2].
+    '''
+    log_link_p = param['log_link_p']
+    symbols = [(b, Epi_string(e, n_epi)) for b in BASES
+               for e in range(1 << n_epi)]
+    table = []
+    for b1, epi1 in symbols:
+        row = []
+        for b2, epi2 in symbols:
+            log_equil = param['log_equil_mat'][b2][epi2]
+            tmp0 = param['Log_transition_dic'][b1][b2] + log_link_p[1] + \
+                param['Log_trans_prod'][epi1][epi2]
+            tmp1 = log_link_p[2] + log_equil
+            row.append(param['log_lamb_mu'] + max(tmp0, tmp1))
+        table.append(row)
+    return table
+
+
+def Symbol_equil(n_epi, param):
+    '''
+    log_equil_mat of every symbol, subtracted from the diagonal-move score
+        of Pair_score_table in each column.
+    return: a list indexed by symbol.
+    '''
+    return [param['log_equil_mat'][b][Epi_string(e, n_epi)] for b in BASES
+            for e in range(1 << n_epi)]
+
+
+def Pair_z_table(n_epi, param):
+    '''
+    For every pair of symbols, whether the diagonal move of Pair_score_table
+        goes through an insertion and a deletion (tmp1 > tmp0) rather than
+        a substitution. Only needed for the alignment path.
+    return: a list of lists of booleans, indexed like Pair_score_table.
+    '''
+    log_link_p = param['log_link_p']
+    symbols = [(b, Epi_string(e, n_epi)) for b in BASES
+               for e in range(1 << n_epi)]
+    table = []
+    for b1, epi1 in symbols:
+        row = []
+        for b2, epi2 in symbols:
+            tmp0 = param['Log_transition_dic'][b1][b2] + log_link_p[1] + \
+                param['Log_trans_prod'][epi1][epi2]
+            tmp1 = log_link_p[2] + param['log_equil_mat'][b2][epi2]
+            row.append(tmp1 > tmp0)
+        table.append(row)
+    return table
+
+
+class EpiFactors:
+    '''
+    The diagonal-move scores of Pair_score_table in factorized form, used
+        instead of the table when there are more than EPI_DENSE_MARKS epi
+        marks.
+    The epi part g(epi1, epi2) of the score is a sum over the marks of one
+        of four terms, depending on the states of the mark in epi1 and epi2.
+        It is written as alpha[epi1] + beta[epi2] + gamma[epi1 & epi2], where
+        the three tables are sums of per-mark terms over the marks set in
+        the bitmask (alpha also holds the terms of the marks in state '0'
+        on both sides). The epi part of log_equil_mat is tabulated in the
+        same way. Each table has 2^n_epi entries and is built in O(2^n_epi),
+        instead of the (4 * 2^n_epi)^2 entries of the score table.
+    marks: the per-mark terms, which determine the tables.
+    base_terms: base_terms[b1][b2] = f(base1, base2) + log p_1.
+    base_equil: the base part of log_equil_mat, by base code.
+    bound: an upper bound of the absolute value of the scores, without
+        diag_norm (see Score_bound).
+    '''
+
+    def __init__(self, n_epi, param, log_equil_dict, weights):
+        log_link_p = param['log_link_p']
+        trans = param['Log_transition_dic']
+        self.n_epi = n_epi
+        self.base_terms = [[trans[b1][b2] + log_link_p[1] for b2 in BASES]
+                           for b1 in BASES]
+        self.base_equil = [log_equil_dict[b] * weights[0] for b in BASES]
+        self.log_link_p2 = log_link_p[2]
+        self.log_lamb_mu = param['log_lamb_mu']
+        self.diag_norm = param['diag_norm']
+        self.marks = []
+        for i in range(1, n_epi + 1):
+            g = trans[i]
+            self.marks.append((
+                g['0']['0'], g['1']['0'] - g['0']['0'],
+                g['0']['1'] - g['0']['0'],
+                g['1']['1'] - g['1']['0'] - g['0']['1'] + g['0']['0'],
+                weights[i] * log_equil_dict[i][0],
+                weights[i] * (log_equil_dict[i][1] - log_equil_dict[i][0])))
+        terms = list(zip(*self.marks))
+        self.alpha = self.bitmask_sums(sum(terms[0]), terms[1])
+        self.beta = self.bitmask_sums(0.0, terms[2])
+        self.gamma = self.bitmask_sums(0.0, terms[3])
+        self.epi_equil = self.bitmask_sums(sum(terms[4]), terms[5])
+        g_bound = sum(max(abs(g[e1][e2]) for e1 in "01" for e2 in "01")
+                      for g in (trans[i] for i in range(1, n_epi + 1)))
+        equil_bound = max(abs(f) for f in self.base_equil) + \
+            sum(max(abs(weights[i] * f) for f in log_equil_dict[i])
+                for i in range(1, n_epi + 1))
+        self.bound = abs(self.log_lamb_mu) + equil_bound + max(
+                max(abs(f) for row in self.base_terms for f in row) +
+                g_bound, abs(self.log_link_p2) + equil_bound)
+
+    def bitmask_sums(self, const, terms):
+        '''
+        For every bitmask of the epi marks, const plus the terms of the
+            marks set in it. The first mark is the most significant bit.
+        return: a list of 2^n_epi sums.
+        '''
+        sums = [const] * (1 << self.n_epi)
+        for e in range(1, 1 << self.n_epi):
+            low = e & -e
+            sums[e] = sums[e ^ low] + terms[self.n_epi - low.bit_length()]
+        return sums
+
+    def __repr__(self):
+        # For Param_digest: the tables follow from these values.
+        return "EpiFactors" + repr((self.n_epi, self.base_terms,
+                                    self.base_equil, self.log_link_p2,
+                                    self.log_lamb_mu, self.diag_norm,
+                                    self.marks))
+
+    def target_terms(self, sym2):
+        '''
+        The terms of the diagonal-move scores that depend on the target
+            alone, for Score_rows.
+        return: (bases, epi-states, beta, log_equil_mat, tmp1), lists over the
+            positions of sym2.
+        '''
+        mask = (1 << self.n_epi) - 1
+        b2 = [s >> self.n_epi for s in sym2]
+        e2 = [s & mask for s in sym2]
+        beta2 = [self.beta[e] for e in e2]
+        equil2 = [self.base_equil[b] + self.epi_equil[e]
+                  for b, e in zip(b2, e2)]
+        tmp1 = [self.log_link_p2 + f for f in equil2]
+        return b2, e2, beta2, equil2, tmp1
+
+    def row(self, sym1, target, z=False):
+        '''
+        The values of Pair_score_table for the query symbol sym1 against the
+            target positions of target_terms, in the same order of
+            operations as Factor_rows. With z=True, the flags of
+            Pair_z_table instead.
+        return: a list.
+        '''
+        b2, e2, beta2, equil2, tmp1 = target
+        f_row = self.base_terms[sym1 >> self.n_epi]
+        e = sym1 & ((1 << self.n_epi) - 1)
+        a = self.alpha[e]
+        gamma = self.gamma
+        tmp0 = [f_row[b] + ((a + beta) + gamma[e & epi])
+                for b, epi, beta in zip(b2, e2, beta2)]
+        if z:
+            return [t1 > t0 for t0, t1 in zip(tmp0, tmp1)]
+        log_lamb_mu = self.log_lamb_mu
+        return [log_lamb_mu + max(t0, t1) for t0, t1 in zip(tmp0, tmp1)]
+
+
+class EpiRows(dict):
+    '''
+    Rows of scores by query symbol, computed by row(sym1) on first use.
+    '''
+
+    def __init__(self, row):
+        dict.__init__(self)
+        self.row = row
+
+    def __missing__(self, sym1):
+        self[sym1] = row = self.row(sym1)
+        return row
+
+
+def Score_rows(param, sym2):
+    '''
+    The score and z tables of the python kernels for a target.
+    With the dense tables, these are param['score_table'], param['z_table']
+        (if built) and sym2. With EpiFactors, the rows of the query symbols
+        are computed against the positions of the target as they are used,
+        and are indexed by position rather than by symbol.
+    return: (score_table, z_table, target, equil2), such that the
+        diagonal-move score of query symbol sym1 against the j-th target
+        position is score_table[sym1][target[j]] + manh3 - equil2[j] -
+        diag_norm (see Pair_score_table).
+    '''
+    factors = param['epi_factors']
+    if factors is None:
+        equil_row = param['equil_row']
+        return (param['score_table'], param.get('z_table'), sym2,
+                [equil_row[s] for s in sym2])
+    target = factors.target_terms(sym2)
+    return (EpiRows(lambda sym1: factors.row(sym1, target)),
+            EpiRows(lambda sym1: factors.row(sym1, target, z=True)),
+            range(len(sym2)), target[3])
+
+
+def Encode_symbols(seq, epi, n_epi):
+    '''
+    Combine base codes and epi-states into symbols indexing the score table.
+    return: a list of symbols.
+    '''
+    return [(b << n_epi) | e for b, e in zip(seq, epi)]
+
+
 # def Transition_g_sum(tuple1, tuple2, log_trans_dic):
 #     '''
 #     Compute the transition probabilities between two sets of epigenomic
@@ -470,41 +1065,119 @@ def Combine_epi_trans(log_trans_dic, log_S_epi):
 #         return log_S_epi["".join(tuple2[1:])]
 
 
-def Backtrack_mat(ind, ind2, bt, i, j, sp):
+# Moves of the alignment path, in the order of their 2-bit codes.
+# u: up (gap in S2), d: diagonal (match or mismatch), z: diagonal through
+# an insertion and a deletion, l: left (gap in S1).
+PATH_MOVES = "udzl"
+
+
+def Path_rows(sym1, sym2, prev, r0, r1, param, bt):
     '''
-    Update the backtrack matrix and record the alignment path.
-    ind, ind2: indices of maxima.
-    bt: the backtrack matrix.
-    i, j: current row and column indices.
-    sp: start point. Either 0 or 1.
+    Fill rows r0 + 1 to r1 of the alignment matrix in the same way as
+        Manhattan, and record the move into each cell.
+    sym1, sym2: the symbols of the two regions (see Encode_symbols).
+    prev: manh3 of row r0.
+    bt: a bytearray with 2 bits per cell of the rows (see PATH_MOVES), or
+        None if the moves are not needed.
+    return: manh3 of row r1.
     '''
-    ind += sp
-    if ind == 0:
-        bt[i][j] = "u"
-    elif ind == 1:
-        if ind2 == 0:
-            bt[i][j] = "d"
-        elif ind2 == 1:
-            bt[i][j] = "z"
-    elif ind == 2:
-        bt[i][j] = "l"
+    n = len(sym2)
+    Na = float('-Inf')
+    score_table, z_table, sym2, equil2 = Score_rows(param, sym2)
+    ent0_comp = param['log_lamb_mu'] + param['log_link_p'][0]
+    half_diag_norm = param['half_diag_norm']
+    diag_norm = param['diag_norm']
+    log_lamb_beta = param['log_lamb_beta']
+    for i in range(r0 + 1, r1 + 1):
+        score_row = score_table[sym1[i - 1]]
+        z_row = z_table[sym1[i - 1]]
+        manh3 = [Na] * (n + 1)
+        manh2 = [Na] * (n + 1)
+        manh3[0] = 0
+        base = (i - r0 - 1) * (n + 1)
+        for j in range(1, n + 1):
+            ent0 = ent0_comp + prev[j] - half_diag_norm
+            ent2 = log_lamb_beta + manh2[j - 1] - half_diag_norm
+            ent1 = score_row[sym2[j - 1]] + prev[j - 1] - equil2[j - 1] - \
+                diag_norm
+
+            max_v3, max_v2, tup_ind1, tup_ind2 = Maximum(ent0, ent1, ent2, j)
+            manh3[j] = max_v3
+            manh2[j] = max_v2
+            if bt is not None:
+                if tup_ind2 == j:
+                    move = 0
+                elif tup_ind1 == 1:
+                    move = 3
+                elif z_row[sym2[j - 1]]:
+                    move = 2
+                else:
+                    move = 1
+                k = base + j
+                bt[k >> 2] |= move << ((k & 3) << 1)
+        prev = manh3
+    return prev
 
 
-def Recons_path(S, bt, j_start, i_start):
+def Align_path(S, param):
+    '''
+    Trace back the optimal alignment path ending at (S.loc1, S.loc2).
+    The moves are stored with 2 bits per cell. If the matrix has more than
+        param['path_cells'] cells, the rows are split into blocks of at most
+        that many cells: a first pass keeps only the manh3 rows at the block
+        boundaries, and the moves of each block are recomputed from its
+        boundary row while tracing back, from the last block to the first.
+        Memory is then bounded by the block size and the boundary rows, at
+        the cost of computing the matrix twice.
+    return: None. The path is stored in S by Recons_path.
     '''
-    Reconstruct the optimal alignment path from the backtrack matrix.
+    S1, E1, S2, E2 = Oriented(S)
+    n = len(S2)
+    sym1 = Encode_symbols(S1, E1, S.n_epi)
+    sym2 = Encode_symbols(S2, E2, S.n_epi)
+    i = S.loc1
+    j = S.loc2
+
+    height = max(1, param['path_cells'] // (n + 1))
+    starts = list(range(0, i, height))
+    ends = starts[1:] + [i]
+    rows = {0: [0] * (n + 1)}
+    for r0, r1 in zip(starts[:-1], ends[:-1]):
+        rows[r1] = Path_rows(sym1, sym2, rows[r0], r0, r1, param, None)
+
+    moves = []
+    for r0, r1 in zip(starts[::-1], ends[::-1]):
+        if i == 0 or j == 0:
+            break
+        bt = bytearray(((r1 - r0) * (n + 1) + 3) // 4)
+        Path_rows(sym1, sym2, rows.pop(r0), r0, r1, param, bt)
+        while i > r0 and j != 0:
+            k = (i - r0 - 1) * (n + 1) + j
+            move = (bt[k >> 2] >> ((k & 3) << 1)) & 3
+            moves.append((move, i, j))
+            if move != 3:
+                i -= 1
+            if move != 0:
+                j -= 1
+    Recons_path(S, moves)
+
+
+def Recons_path(S, moves):
+    '''
+    Reconstruct the optimal alignment path from the moves of the trace back.
     S: a HomoRegion object.
-    bt: the backtrack matrix.
-    j_start: the index at which the maximal alignment score is found.
+    moves: a list of (move, i, j) from the end of the path to its start,
+        where move is the code of the move into cell (i, j) (see
+        PATH_MOVES).
     '''
     if len(S.S1) <= len(S.S2):
-        S1 = S.S1
-        S2 = S.S2
+        S1, E1 = S.S1, S.S1_epi
+        S2, E2 = S.S2, S.S2_epi
     else:
-        S1 = S.S2
-        S2 = S.S1
+        S1, E1 = S.S2, S.S2_epi
+        S2, E2 = S.S1, S.S1_epi
 
-    n_epi = len(S.S1[0]) - 1
+    n_epi = S.n_epi
     S_match = ""
     S1_epi_path = {}
     S2_epi_path = {}
@@ -512,64 +1185,62 @@ def Recons_path(S, bt, j_start, i_start):
         S1_epi_path[k] = ""
         S2_epi_path[k] = ""
 
-    i = i_start  # S1
-    j = j_start  # S2
-
     S1_align = ""
     S2_align = ""
-    while i != 0 and j != 0:
-        if bt[i][j] == "d":
-            S1_align += S1[i - 1][0]
-            S2_align += S2[j - 1][0]
+    for move, i, j in moves:
+        move = PATH_MOVES[move]
+        if move == "d":
+            S1_align += BASES[S1[i - 1]]
+            S2_align += BASES[S2[j - 1]]
             for k in range(1, n_epi + 1):
-                S1_epi_path[k] += S1[i - 1][k]
-                S2_epi_path[k] += S2[j - 1][k]
-            if S1[i - 1][0] == S2[j - 1][0]:
+                S1_epi_path[k] += Epi_string(E1[i - 1], n_epi)[k - 1]
+                S2_epi_path[k] += Epi_string(E2[j - 1], n_epi)[k - 1]
+            if S1[i - 1] == S2[j - 1]:
                 S_match += "|"
             else:
                 S_match += " "
-            i = i - 1
-            j = j - 1
-        elif bt[i][j] == "l":
+        elif move == "l":
             S1_align += "-"
-            S2_align += S2[j - 1][0]
+            S2_align += BASES[S2[j - 1]]
             for k in range(1, n_epi + 1):
                 S1_epi_path[k] += "-"
-                S2_epi_path[k] += S2[j - 1][k]
+                S2_epi_path[k] += Epi_string(E2[j - 1], n_epi)[k - 1]
             S_match += " "
-            j = j - 1
-        elif bt[i][j] == "u":
-            S1_align += S1[i - 1][0]
+        elif move == "u":
+            S1_align += BASES[S1[i - 1]]
             S2_align += "-"
             for k in range(1, n_epi + 1):
-                S1_epi_path[k] += S1[i - 1][k]
+                S1_epi_path[k] += Epi_string(E1[i - 1], n_epi)[k - 1]
                 S2_epi_path[k] += "-"
             S_match += " "
-            i = i - 1
-        elif bt[i][j] == "z":
-            S1_align += (S1[i - 1][0] + "-")
-            S2_align += ("-" + S2[j - 1][0])
+        elif move == "z":
+            S1_align += (BASES[S1[i - 1]] + "-")
+            S2_align += ("-" + BASES[S2[j - 1]])
             for k in range(1, n_epi + 1):
-                S1_epi_path[k] += (S1[i - 1][k] + "-")
-                S2_epi_path[k] += ("-" + S2[j - 1][k])
-            S_match += " "
-            i = i - 1
-            j = j - 1
-
+                S1_epi_path[k] += (Epi_string(E1[i - 1], n_epi)[k - 1] + "-")
+                S2_epi_path[k] += ("-" + Epi_string(E2[j - 1], n_epi)[k - 1])
+            S_match += "  "
+
+    # Leading gaps in the shorter region are not part of the alignment.
+    S1_align = S1_align[::-1]
+    t = len(S1_align) - len(S1_align.lstrip("-"))
+    S1_align = S1_align[t:]
+    S2_align = S2_align[::-1][t:]
+    S_match = S_match[::-1][t:]
     for k in range(1, n_epi + 1):
-        S1_epi_path[k] = S1_epi_path[k][::-1]
-        S2_epi_path[k] = S2_epi_path[k][::-1]
+        S1_epi_path[k] = S1_epi_path[k][::-1][t:]
+        S2_epi_path[k] = S2_epi_path[k][::-1][t:]
 
-    if len(S.S1) < len(S.S2):
-        S.S1_path = S1_align[::-1].lstrip("-")
-        S.S2_path = S2_align[len(S.S1_path) - 1::-1]
-        S.S_match = S_match[::-1]
+    if len(S.S1) <= len(S.S2):
+        S.S1_path = S1_align
+        S.S2_path = S2_align
+        S.S_match = S_match
         S.S1_epi_path = S1_epi_path
         S.S2_epi_path = S2_epi_path
     else:
-        S.S2_path = S1_align[::-1].lstrip("-")
-        S.S1_path = S2_align[len(S.S1_path) - 1::-1]
-        S.S_match = S_match[::-1]
+        S.S2_path = S1_align
+        S.S1_path = S2_align
+        S.S_match = S_match
         S.S2_epi_path = S1_epi_path
         S.S1_epi_path = S2_epi_path
 
@@ -582,7 +1253,7 @@ def Print_path(S0, fout2):
     S0: a HomoRegion.
     fout2: the output file where to print the alignment path.
     '''
-    n_epi = len(S0.S1[0]) - 1
+    n_epi = S0.n_epi
     j = 0
     while j + 100 < len(S0.S1_path):
         print("@Sequence name: " + S0.name, file=fout2)
@@ -665,108 +1336,137 @@ def Manhattan(S, param):
     Initialize and fill the matrices in dynamic programming for alignment
         score computation.
     S: a HomoRegion object.
-    X: the parameter vector containing s, mu and kappas.
-    log_trans_dic: the dictionary containing transition probabilities on
-        log scale, constructed by Trans_matrix.
+    param: the parameter dictionary. The diagonal-move scores are looked up
+        in param['score_table'], constructed by Pair_score_table, or computed
+        from param['epi_factors'] (see Score_rows).
     Note that the argument to be distributed to different processes should
         be the first one.
     return: the updated S.
     '''
     if len(S.S1) <= len(S.S2):
-        S1 = S.S1
-        S2 = S.S2
+        S1, E1 = S.S1, S.S1_epi
+        S2, E2 = S.S2, S.S2_epi
     else:
-        S1 = S.S2
-        S2 = S.S1
+        S1, E1 = S.S2, S.S2_epi
+        S2, E2 = S.S1, S.S1_epi
     m = len(S1)
     n = len(S2)
 
+    sym1 = Encode_symbols(S1, E1, S.n_epi)
+    score_table, _, sym2, equil2 = Score_rows(
+        param, Encode_symbols(S2, E2, S.n_epi))
+
     Na = float('-Inf')
 
     # Initialization
     # maximum of three values (manh0, manh1, manh2), maximum of two values
-    # (manh1, manh2)
+    # (manh1, manh2). Two buffers of each kind are allocated once and used in
+    # turn for the previous and the current row.
     manh3 = [[Na] * (n + 1) for i in range(2)]
     manh2 = [[Na] * (n + 1) for i in range(2)]
-    # Start point. The first row and column: all start from the position
-    # itself.
-    manh3_st = [[Na] * (n + 1) for i in range(2)]
+    # Start points, as the row and the column of the start cell. The first
+    # row and column: all start from the position itself.
+    st_row = [array("l", bytes(8 * (n + 1))) for i in range(2)]
+    st_col = [array("l", bytes(8 * (n + 1))) for i in range(2)]
     # last column
     last_col = [Na] * (m + 1)
     # last colum start point
-    last_col_st = [Na] * (m + 1)
+    last_col_st_row = array("l", bytes(8 * (m + 1)))
+    last_col_st_col = array("l", bytes(8 * (m + 1)))
 
     # 0,0
     init0 = 0
     # init0 = log_link_p[3] + log(Gamma(0,lamb,mu))
 
+    prev3, prev2 = manh3[0], manh2[0]
+    prev_row, prev_col = st_row[0], st_col[0]
     for i in range(0, n + 1):
-        manh3[0][i] = init0
-        manh2[0][i] = init0
-        manh3_st[0][i] = (0, i)
-
-    # 1,0
-    manh3[1][0] = init0
-    manh3_st[1][0] = (1, 0)
+        prev3[i] = init0
+        prev2[i] = init0
+        prev_col[i] = i
 
     ent0_comp = param['log_lamb_mu'] + param['log_link_p'][0]
+    half_diag_norm = param['half_diag_norm']
+    diag_norm = param['diag_norm']
+    log_lamb_beta = param['log_lamb_beta']
 
     # Dynamic programming starts
     for i in range(1, (m + 1)):
+        cur3, cur2 = manh3[i & 1], manh2[i & 1]
+        cur_row, cur_col = st_row[i & 1], st_col[i & 1]
+        prev3, prev2 = manh3[~i & 1], manh2[~i & 1]
+        prev_row, prev_col = st_row[~i & 1], st_col[~i & 1]
+        # i,0
+        cur3[0] = init0
+        cur2[0] = Na
+        cur_row[0] = i
+        cur_col[0] = 0
+
+        score_row = score_table[sym1[i - 1]]
         for j in range(1, (n + 1)):
-            tmp0 = param['Log_transition_dic'][S1[i - 1][0]][S2[j - 1][0]] + \
-                param['log_link_p'][1] + \
-                param['Log_trans_prod'][S1[i - 1][1]][S2[j - 1][1]]
-            tmp1 = param['log_link_p'][2] + \
-                param['log_equil_mat'][S2[j - 1][0]][S2[j - 1][1]]
-
-            max_t = max(tmp0, tmp1)
-
-            ent0 = ent0_comp + manh3[0][j] - param['half_diag_norm']
-
-            ent2 = param['log_lamb_beta'] + manh2[1][j - 1] - \
-                param['half_diag_norm']
-
-            ent1 = param['log_lamb_mu'] + max_t + \
-                manh3[0][j - 1] - \
-                param['log_equil_mat'][S2[j - 1][0]][S2[j - 1][1]] - \
-                param['diag_norm']
-
-            max_v3, max_v2, tup_ind1, tup_ind2 = Maximum(ent0, ent1, ent2, j)
-
-            manh3[1][j] = max_v3
-            manh2[1][j] = max_v2
-            manh3_st[1][j] = manh3_st[tup_ind1][tup_ind2]
-
-        last_col[i] = manh3[1][-1]
-        last_col_st[i] = manh3_st[1][-1]
-
-        manh3[0] = manh3[1]
-        manh3[1] = [Na] * (n + 1)
+            ent0 = ent0_comp + prev3[j] - half_diag_norm
 
-        manh2[0] = manh2[1]
-        manh2[1] = [Na] * (n + 1)
+            ent2 = log_lamb_beta + cur2[j - 1] - half_diag_norm
 
-        manh3_st[0] = manh3_st[1]
-        manh3_st[1] = [Na] * (n + 1)
-        # print manh3_st[0]
+            ent1 = score_row[sym2[j - 1]] + prev3[j - 1] - \
+                equil2[j - 1] - diag_norm
 
-        if i < m:
-            manh3[1][0] = init0
+            # Same as Maximum, without building tuples.
+            if ent1 >= ent2:
+                cur2[j] = ent1
+                if ent0 >= ent1:
+                    cur3[j] = ent0
+                    cur_row[j] = prev_row[j]
+                    cur_col[j] = prev_col[j]
+                else:
+                    cur3[j] = ent1
+                    cur_row[j] = prev_row[j - 1]
+                    cur_col[j] = prev_col[j - 1]
+            else:
+                cur2[j] = ent2
+                if ent0 >= ent2:
+                    cur3[j] = ent0
+                    cur_row[j] = prev_row[j]
+                    cur_col[j] = prev_col[j]
+                else:
+                    cur3[j] = ent2
+                    cur_row[j] = cur_row[j - 1]
+                    cur_col[j] = cur_col[j - 1]
 
-            manh3_st[1][0] = (i + 1, 0)
+        last_col[i] = cur3[n]
+        last_col_st_row[i] = cur_row[n]
+        last_col_st_col[i] = cur_col[n]
 
     #  print norm_max_list
     #  print plen_flist
     #  print last_col
-    last_row_max = max(manh3[0][1:])
+    last_row = manh3[m & 1]
+    last_row_st = list(zip(st_row[m & 1], st_col[m & 1]))
+    last_col_st = [Na] + list(zip(last_col_st_row[1:], last_col_st_col[1:]))
+    Summarize_scores(S, last_row, last_row_st, last_col, last_col_st, param)
+    return S
+
+
+def Summarize_scores(S, last_row, last_row_st, last_col, last_col_st, param):
+    '''
+    Find the maximal alignment score in the last row and the last column of
+        the alignment matrix and record it in S.
+    last_row, last_col: lists of scores in the last row and the last column,
+        including the 0-th entries.
+    last_row_st, last_col_st: start points (tuples) of the entries.
+    return: None. S will be updated directly.
+    '''
+    Na = float('-Inf')
+    m = len(last_col) - 1
+    n = len(last_row) - 1
+    last_row_max = max(last_row[1:])
     last_col_max = max(last_col[1:])
 
     S.L = max(last_row_max, last_col_max)
     if last_row_max >= last_col_max:
         i_start = m
-        j_start = manh3[0].index(last_row_max)
-        S.start_point = manh3_st[0][j_start]
+        j_start = last_row.index(last_row_max)
+        S.start_point = last_row_st[j_start]
     else:
         i_start = last_col.index(last_col_max)
         j_start = n
@@ -776,40 +1476,1407 @@ def Manhattan(S, param):
     #    print >> sys.stderr, " ".join(line)
     S.loc2 = j_start
     S.loc1 = i_start
-    S.averagedL = sum(manh3[0][1:] + last_col[1:]) / float(m + n)
-    if param['all_prob']:
-        S.prob = manh3[0][1:] + last_col[1:]
+    # Cells outside the band of a banded alignment are not counted.
+    scores = [f for f in last_row[1:] + last_col[1:] if f != Na]
+    S.averagedL = sum(scores) / float(len(scores)) if scores else Na
+    if param['all_prob'] or param['hit_summary']:
+        S.prob = last_row[1:] + last_col[1:]
+
+
+def Kernel_precision(params, m, n):
+    '''
+    The number type used by the numpy kernels for an m x n matrix:
+        params[0]['precision'], except that the fixed-point mode falls back
+        to float64 if int32 scores might overflow.
+    '''
+    precision = params[0]['precision']
+    if precision == "fixed":
+        # Scores are sums of at most m + n terms, plus the column offsets
+        # of the manh2 scan (see Manhattan_np_sets).
+        term = max(Score_bound(p) +
+                   abs(p['log_lamb_mu']) + abs(p['log_link_p'][0]) +
+                   abs(p['log_lamb_beta']) + abs(p['half_diag_norm']) +
+                   abs(p['diag_norm']) for p in params)
+        if 2 * (m + n + 2) * term * FIXED_SCALE >= -FIXED_NA // 2:
+            return "float64"
+    return precision
+
+
+def Score_bound(param):
+    '''
+    An upper bound of the absolute value of the diagonal-move scores,
+        without diag_norm.
+    '''
+    if param['epi_factors'] is not None:
+        return param['epi_factors'].bound
+    return max(abs(f) for row in param['score_table'] for f in row) + \
+        max(abs(f) for f in param['equil_row'])
+
+
+def Kernel_array(values, precision):
+    '''
+    Convert scores to the number type of a precision. In the fixed-point
+        mode, scores are rounded to multiples of 1 / FIXED_SCALE and -Inf
+        becomes FIXED_NA.
+    return: a numpy array.
+    '''
+    a = np.asarray(values, dtype=float)
+    if precision == "fixed":
+        return np.where(np.isneginf(a), FIXED_NA,
+                        np.round(a * FIXED_SCALE)).astype(np.int32)
+    return a.astype(precision)
+
+
+def Kernel_scores(a, precision):
+    '''
+    Convert scores of the number type of a precision back to float64.
+    '''
+    if precision == "fixed":
+        return np.where(a < FIXED_NA // 2, float('-Inf'), a / FIXED_SCALE)
+    return a.astype(float)
+
+
+class ArrayCache:
+    '''
+    Arrays built from the score tables of the parameter sets, kept in a
+        process and shared read-only by the pairs aligned there.
+    Entries are kept least recently used first, within max_bytes. An entry
+        larger than a quarter of max_bytes is not kept. The tables are kept
+        with each entry, so that their ids, which are part of the keys, stay
+        valid.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = {}
+        self.nbytes = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def get(self, key, tables, build):
+        '''
+        The arrays of key, made by build() if they are not kept.
+        key: a hashable value, to which the ids of tables are added.
+        build: a function returning an array or a tuple of arrays.
+        '''
+        key = (key, tuple(id(t) for t in tables))
+        entry = self.entries.pop(key, None)
+        if entry is not None and any(
+                a is not b for a, b in zip(entry[0], tables)):
+            self.nbytes -= entry[2]
+            entry = None
+        if entry is None:
+            value = build()
+            arrays = value if isinstance(value, tuple) else (value,)
+            size = sum(a.nbytes for a in arrays)
+            if 4 * size > self.max_bytes:
+                return value
+            for a in arrays:
+                a.flags.writeable = False
+            entry = (tables, value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                old = self.entries.pop(next(iter(self.entries)))
+                self.nbytes -= old[2]
+        self.entries[key] = entry
+        return entry[1]
+
+
+# Query profiles (Query_profile) and target columns (Target_columns) built
+# in this process.
+query_profiles = ArrayCache(64 << 20)
+target_columns = ArrayCache(16 << 20)
+
+
+def Query_profile(seq, epi, n_epi, params, precision):
+    '''
+    The query profile of the region in the rows of the alignment matrix:
+        profile[k, i] holds the values of Pair_score_table of row symbol i
+        against every target symbol with parameter set k, so that each row
+        of the numpy kernels is one gather from a contiguous vector.
+    In cluster mode and in cross products of promoters, the same query is
+        aligned against many targets. Profiles are kept in query_profiles
+        and built once per query, parameter sets and precision in each
+        process. Collect_results hands the pairs of a query to the workers
+        together (see Group_keys).
+    return: a numpy array of shape (len(params), len(seq), number of symbols).
+    '''
+    tables = tuple(p['score_table'] for p in params)
+
+    def Build():
+        sym1 = Encode_symbols(seq, epi, n_epi)
+        return np.ascontiguousarray(Kernel_array(tables, precision)[:, sym1])
+    return query_profiles.get((seq.tobytes(), epi.tobytes(), n_epi,
+                               precision), tables, Build)
+
+
+def Target_columns(seq, epi, n_epi, params, precision):
+    '''
+    The terms of the diagonal moves that depend on the region in the
+        columns of the alignment matrix alone: its symbols (see
+        Encode_symbols), which index the query profile, and log_equil_mat
+        of each position with each parameter set, subtracted from the
+        diagonal moves (see Pair_score_table).
+    In promoter runs, the same target is aligned against many queries. The
+        columns are kept in target_columns and built once per target,
+        parameter sets and precision in each process, and Collect_results
+        hands the pairs of a target to the workers together when targets
+        are shared more than queries (see Group_keys).
+    return: (sym2, equil2), numpy arrays of shape (len(seq),) and
+        (len(params), len(seq)), the latter of the number type of
+        precision.
+    '''
+    tables = tuple(p['equil_row'] for p in params)
+
+    def Build():
+        sym2 = np.frombuffer(seq, dtype=np.uint8).astype(np.intp) * \
+            (1 << n_epi) + \
+            np.frombuffer(epi, dtype=epi.typecode).astype(np.intp)
+        return sym2, Kernel_array(tables, precision)[:, sym2]
+    return target_columns.get((seq.tobytes(), epi.tobytes(), n_epi,
+                               precision), tables, Build)
+
+
+def Query_key(S):
+    '''
+    The region of a pair in the rows of the alignment matrix (see Oriented).
+    '''
+    S1, E1 = Oriented(S)[:2]
+    return S1.tobytes(), E1.tobytes()
+
+
+def Target_key(S):
+    '''
+    The region of a pair in the columns of the alignment matrix.
+    '''
+    S2, E2 = Oriented(S)[2:]
+    return S2.tobytes(), E2.tobytes()
+
+
+def Group_keys(S, todo):
+    '''
+    The keys by which the pairs are grouped into the chunks of the workers:
+        their queries (Query_key), which share a query profile, or if fewer
+        pairs share a query than a target, their targets (Target_key),
+        which share the target columns.
+    return: a dictionary from the indices of todo to the keys.
+    '''
+    queries = {i: Query_key(S[i]) for i in todo}
+    targets = {i: Target_key(S[i]) for i in todo}
+    if len(set(targets.values())) < len(set(queries.values())):
+        return targets
+    return queries
+
+
+def Factor_rows(seq1, epi1, seq2, epi2, params, precision):
+    '''
+    The values of Pair_score_table for the numpy kernels when the parameter
+        sets hold EpiFactors instead of score tables. The terms that depend
+        on the target alone are computed once, and the rest row by row, in
+        float64 and in the same order of operations as EpiFactors.row.
+    return: (row, equil2). row(i, cols) gives the values of the i-th query
+        position (1-based) against the target positions cols, as an array
+        of shape (len(params), len(cols)) of the number type of precision.
+        equil2 is log_equil_mat of the target positions, as in
+        Target_columns.
+    '''
+    factors = [p['epi_factors'] for p in params]
+    b2 = np.frombuffer(seq2, dtype=np.uint8).astype(np.intp)
+    e2 = np.frombuffer(epi2, dtype=epi2.typecode).astype(np.intp)
+    base_terms = np.array([f.base_terms for f in factors])
+    alpha = np.array([f.alpha for f in factors])
+    gamma = np.array([f.gamma for f in factors])
+    beta2 = np.array([f.beta for f in factors])[:, e2]
+    equil2 = np.array([f.base_equil for f in factors])[:, b2] + \
+        np.array([f.epi_equil for f in factors])[:, e2]
+    tmp1 = np.array([[f.log_link_p2] for f in factors]) + equil2
+    log_lamb_mu = np.array([[f.log_lamb_mu] for f in factors])
+
+    def row(i, cols):
+        b = seq1[i - 1]
+        e = epi1[i - 1]
+        tmp0 = base_terms[:, b].take(b2[cols], axis=1) + (
+            (alpha[:, e:e + 1] + beta2[:, cols]) + gamma[:, e & e2[cols]])
+        return Kernel_array(log_lamb_mu + np.maximum(tmp0, tmp1[:, cols]),
+                            precision)
+    return row, Kernel_array(equil2, precision)
+
+
+def Gap_scores(ent1, step, log_lamb_beta, half_diag_norm, Na, precision):
+    '''
+    manh2 of the cells of a row segment of the numpy kernels, given ent1.
+        manh2 of a cell is max(ent1, log_lamb_beta + manh2 on its left -
+        half_diag_norm), and manh2 left of the segment is Na.
+    The running maximum of ent1 - step, shifted back by step, gives manh2
+        with one rounding per cell instead of two per move, which decides
+        near-ties differently from Manhattan. It is exact in the fixed-point
+        mode, and kept as it is with float32. With float64, it only tells
+        which cells start a run of left moves. The runs are then added up
+        move by move in one np.add.accumulate over the row, in which adding
+        and subtracting GAP_FLUSH clears the sum at the start of each run.
+        The few cells whose start was misjudged are recomputed one by one,
+        so that the scores are those of Manhattan to the last bit.
+    ent1: an array of shape (rows, w).
+    step: the column offsets of the segment (see Manhattan_np_sets),
+        broadcastable to ent1.
+    log_lamb_beta, half_diag_norm: scalars or columns of the rows.
+    return: an array of shape (rows, w + 1), whose column t is manh2 left of
+        the t-th cell.
+    '''
+    rows, w = ent1.shape
+    manh2 = np.empty((rows, w + 1), dtype=ent1.dtype)
+    manh2[:, 0] = Na
+    shifted = ent1 - step
+    run = np.maximum.accumulate(shifted, axis=1)
+    if precision != "float64":
+        manh2[:, 1:] = run + step
+        return manh2
+    start = np.empty((rows, w), dtype=bool)
+    start[:, 0] = True
+    np.greater_equal(shifted[:, 1:], run[:, :-1], out=start[:, 1:])
+    # Three terms per cell: flush, unflush and ent1 at the start of a run,
+    # log_lamb_beta, -half_diag_norm and 0 elsewhere. No left move follows
+    # a cell of -Inf (ent1 >= -Inf), whose term is 0 so as not to stick.
+    terms = np.empty((rows, w, 3))
+    terms[:, :, 0] = np.where(start, GAP_FLUSH, log_lamb_beta)
+    terms[:, :, 1] = np.where(start, -GAP_FLUSH, -half_diag_norm)
+    terms[:, :, 2] = np.where(start & (ent1 != Na), ent1, 0.0)
+    terms = terms.reshape(rows, 3 * w)
+    np.add.accumulate(terms, axis=1, out=terms)
+    manh2[:, 1:] = np.where(start, ent1, terms[:, 2::3])
+    new = np.maximum(ent1[:, 1:],
+                     log_lamb_beta + manh2[:, 1:-1] - half_diag_norm)
+    changed = np.flatnonzero(new != manh2[:, 2:])
+    if changed.size == 0:
+        return manh2
+    # Follow the recurrence from each wrong cell, left to right, until it
+    # agrees with the accumulated scores again.
+    flat = manh2.reshape(-1)
+    get = flat.item
+    get_ent1 = ent1.reshape(-1).item
+    log_lamb_beta = np.broadcast_to(log_lamb_beta, (rows, 1))[:, 0].tolist()
+    half_diag_norm = np.broadcast_to(
+        half_diag_norm, (rows, 1))[:, 0].tolist()
+    for c in changed.tolist():
+        r, t = divmod(c, w - 1)
+        lb = log_lamb_beta[r]
+        hdn = half_diag_norm[r]
+        k = r * (w + 1) + t + 1
+        j = r * w + t + 1
+        end = (r + 1) * (w + 1) - 1
+        v = get(k)
+        while k < end:
+            v = lb + v - hdn
+            f = get_ent1(j)
+            if f >= v:
+                v = f
+            k += 1
+            j += 1
+            if v == get(k):
+                break
+            flat[k] = v
+    return manh2
+
+
+def Band_of(S, m, n, param):
+    '''
+    The diagonal band of a region pair in the orientation of the kernels
+        (shorter region in rows).
+    The expected diagonal S.diag is the offset of the first region in the
+        second region: cell (i, j) of the input orientation is in the band
+        when |j - i - diag| <= param['band'].
+    return: (d, w) such that cell (i, j) of the kernel matrix is in the band
+        when |j - i - d| <= w, or None if the pair is aligned in full.
+    '''
+    if S.diag is None or param['band'] is None:
+        return None
+    d = S.diag if len(S.S1) <= len(S.S2) else -S.diag
+    w = param['band']
+    # The band must contain a start cell in the first row or column, and a
+    # cell beyond it: a band that only touches the corner cell (0, n) or
+    # (m, 0) has no finite scores, and the pair is aligned in full.
+    if d - w >= n or d + w <= -m:
+        return None
+    return d, w
+
+
+def Manhattan_np(S, param):
+    '''
+    The same as Manhattan, but each row of the matrices is computed with
+        numpy array operations. See Manhattan_np_sets.
+    S: a HomoRegion object.
+    return: the updated S.
+    '''
+    Manhattan_np_sets(S, [param])
+    return S
+
+
+def Manhattan_np_sets(S, params):
+    '''
+    Fill the matrices of a region pair for several parameter sets in one
+        traversal. The arrays have a parameter axis (one row per set), and
+        each row of the matrices is computed with numpy array operations for
+        all sets at once.
+    The only dependency within a row is ent2, which adds a constant to the
+        manh2 entry on its left. Therefore, manh2 of a row is a running
+        maximum of ent1 - j * c, shifted back by j * c, where
+        c = log_lamb_beta - half_diag_norm, corrected to the rounding of
+        Manhattan (see Gap_scores). Start points are propagated from the
+        previous row (ent0, ent1) or forward-filled from the left (ent2).
+    If S.diag and param['band'] are set, only cells in the band around the
+        expected diagonal are computed (see Band_of) and the other cells are
+        -Inf. S.band_edge records whether the optimal path touched the edge
+        of the band, in which case a wider band may give a better score. The
+        band is taken from the first parameter set.
+    With the float64 precision, the scores and the positions are the same
+        as those of Manhattan, ties included (see Kernel_precision for the
+        other ones).
+    S: a HomoRegion object.
+    params: a list of parameter dictionaries.
+    return: a list of result records (see Result_record), one per parameter
+        set. S is left with the results of the last set.
+    '''
+    if len(S.S1) <= len(S.S2):
+        b1, e1 = S.S1, S.S1_epi
+        S2, E2 = S.S2, S.S2_epi
+    else:
+        b1, e1 = S.S2, S.S2_epi
+        S2, E2 = S.S1, S.S1_epi
+    m = len(b1)
+    n = len(S2)
+    K = len(params)
+    precision = Kernel_precision(params, m, n)
+
+    if params[0]['epi_factors'] is None:
+        profile = Query_profile(b1, e1, S.n_epi, params, precision)
+        dtype = profile.dtype
+        sym2, equil2 = Target_columns(S2, E2, S.n_epi, params, precision)
+        factor_rows = None
+    else:
+        factor_rows, equil2 = Factor_rows(b1, e1, S2, E2, params, precision)
+        dtype = Kernel_array(0.0, precision).dtype
+
+    Na = Kernel_array(float('-Inf'), precision)
+    init0 = 0
+    # Constants of each parameter set, as columns.
+    ent0_comp = Kernel_array(
+        [[p['log_lamb_mu'] + p['log_link_p'][0]] for p in params], precision)
+    half_diag_norm = Kernel_array(
+        [[p['half_diag_norm']] for p in params], precision)
+    diag_norm = Kernel_array([[p['diag_norm']] for p in params], precision)
+    log_lamb_beta = Kernel_array(
+        [[p['log_lamb_beta']] for p in params], precision)
+    if precision == "fixed":
+        # Exact, so that the manh2 scan is exact as well.
+        ent2_step = log_lamb_beta - half_diag_norm
+    else:
+        ent2_step = Kernel_array(
+            [[p['log_lamb_beta'] - p['half_diag_norm']] for p in params],
+            precision)
+
+    cols = np.arange(n + 1)
+    step = (cols[1:] * ent2_step).astype(dtype)
+    sets = np.arange(K)[:, None]
+    set_cols = np.tile(cols, (K, 1))
+    band = Band_of(S, m, n, params[0])
+
+    # Row 0: all start from the position itself.
+    # Two buffers of each kind are used in turn for the previous and the
+    # current row. Outside the band, only cells that are never read again
+    # keep stale values.
+    # Start points are packed as row << 32 | column.
+    manh3 = np.full((K, n + 1), init0, dtype=dtype)
+    st = set_cols.astype(np.int64)
+    if band:
+        d, w = band
+        manh3[:] = Na
+        manh3[:, max(0, d - w):max(0, min(n, d + w) + 1)] = init0
+        edge = np.tile((cols == d - w) | (cols == d + w), (K, 1))
+    new3 = np.full((K, n + 1), Na, dtype=dtype)
+    new_st = np.zeros((K, n + 1), dtype=np.int64)
+    new_edge = np.zeros((K, n + 1), dtype=bool)
+
+    last_col = np.full((K, m + 1), Na, dtype=dtype)
+    last_col_st = np.zeros((K, m + 1), dtype=np.int64)
+    last_col_edge = np.zeros((K, m + 1), dtype=bool)
+    lo, hi = 1, n
+    S.cells = 0
+
+    for i in range(1, m + 1):
+        new3[:, 0] = init0
+        new_st[:, 0] = i << 32
+        if band:
+            lo = max(1, i + d - w)
+            hi = min(n, i + d + w)
+            if abs(i + d) > w:
+                new3[:, 0] = Na
+            new_edge[:, 0] = (-i == d - w) or (-i == d + w)
+        if lo <= hi:
+            S.cells += hi - lo + 1
+            seg = slice(lo, hi + 1)
+            prev = slice(lo - 1, hi)
+
+            ent0 = ent0_comp + manh3[:, seg] - half_diag_norm
+            # In the order of operations of Manhattan.
+            if factor_rows is None:
+                ent1 = profile[:, i - 1].take(sym2[prev], axis=1) + \
+                    manh3[:, prev]
+            else:
+                ent1 = factor_rows(i, prev) + manh3[:, prev]
+            ent1 = ent1 - equil2[:, prev] - diag_norm
+            # manh2 of the column left of the segment is -Inf: it is either
+            # column 0 or outside the band.
+            manh2 = Gap_scores(ent1, step[:, prev], log_lamb_beta,
+                               half_diag_norm, Na, precision)[:, :-1]
+            ent2 = log_lamb_beta + manh2 - half_diag_norm
+
+            # Same tie-breaking as Maximum: ent0, then ent1, then ent2.
+            up = ent0 >= np.maximum(ent1, ent2)
+            left = ~up & (ent2 > ent1)
+            new3[:, seg] = np.where(up, ent0, np.where(left, ent2, ent1))
+
+            # Start points of up and diagonal moves come from the previous
+            # row. Left moves take the start point of the nearest cell on
+            # the left that is not a left move. A left move never wins in
+            # the first cell of the segment, because its ent2 is -Inf.
+            # src holds indices into the flattened (set, segment) arrays.
+            src = set_cols[:, :hi - lo + 1].copy()
+            src[left] = 0
+            src = np.maximum.accumulate(src, axis=1) + sets * (hi - lo + 1)
+            new_st[:, seg] = np.where(up, st[:, seg], st[:, prev]).take(src)
+            if band:
+                new_edge[:, seg] = np.where(
+                    up, edge[:, seg], edge[:, prev]).take(src)
+                new_edge[:, lo] |= (lo - i == d - w)
+                new_edge[:, hi] |= (hi - i == d + w)
+
+        manh3, new3 = new3, manh3
+        st, new_st = new_st, st
+        if band:
+            edge, new_edge = new_edge, edge
+
+        if lo <= n <= hi:
+            last_col[:, i] = manh3[:, n]
+            last_col_st[:, i] = st[:, n]
+            if band:
+                last_col_edge[:, i] = edge[:, n]
+
+    if band:
+        # Clear the stale cells of the last row.
+        keep = (cols >= lo) & (cols <= hi)
+        keep[0] = abs(m + d) <= w
+        manh3 = np.where(keep, manh3, Na)
+    manh3 = Kernel_scores(manh3, precision)
+    last_col = Kernel_scores(last_col, precision)
+    Na = float('-Inf')
+    records = []
+    for k, param in enumerate(params):
+        last_row = manh3[k].tolist()
+        last_row_st = list(zip((st[k] >> 32).tolist(),
+                               (st[k] & 0xffffffff).tolist()))
+        lc = last_col[k].tolist()
+        lc_st = [Na] + list(zip((last_col_st[k, 1:] >> 32).tolist(),
+                                (last_col_st[k, 1:] & 0xffffffff).tolist()))
+        Summarize_scores(S, last_row, last_row_st, lc, lc_st, param)
+        if band:
+            if S.loc1 == m:
+                S.band_edge = bool(edge[k, S.loc2])
+            else:
+                S.band_edge = bool(last_col_edge[k, S.loc1])
+        records.append(Result_record(S))
+    return records
+
+
+def Kmers(seq, k):
+    '''
+    The k-mers of a region at each start position, as numpy void scalars
+        that compare and sort by their bytes.
+    '''
+    a = np.frombuffer(seq, dtype=np.uint8)
+    if len(a) < k:
+        return np.empty(0, dtype="V" + str(k))
+    return np.ascontiguousarray(
+        np.lib.stride_tricks.sliding_window_view(a, k)).view(
+            "V" + str(k)).ravel()
+
+
+def Find_seeds(S1, E1, S2, E2, k, max_occ):
+    '''
+    Find exact k-mer matches between the bases of S1 and S2, in which the
+        epi-states of more than half of the k positions also agree.
+    K-mers that occur more than max_occ times in either region are skipped,
+        so that low-complexity regions do not give a number of seeds
+        quadratic in their lengths.
+    return: a list of the diagonals (j - i) of the seeds.
+    '''
+    kmers1, inv1, count1 = np.unique(
+        Kmers(S1, k), return_inverse=True, return_counts=True)
+    kmers2, inv2, count2 = np.unique(
+        Kmers(S2, k), return_inverse=True, return_counts=True)
+    if len(kmers1) == 0 or len(kmers2) == 0:
+        return []
+    # Target k-mers present in the query, and not repeated in either region.
+    pos = np.minimum(np.searchsorted(kmers1, kmers2), len(kmers1) - 1)
+    keep = (kmers1[pos] == kmers2) & (count2 <= max_occ) & \
+        (count1[pos] <= max_occ)
+    j = np.flatnonzero(keep[inv2])
+    kmer = pos[inv2[j]]
+    # Query positions grouped by k-mer, in increasing order.
+    order = np.argsort(inv1.ravel(), kind="stable")
+    first = np.concatenate(([0], np.cumsum(count1)[:-1]))
+    hits = count1[kmer]
+    j = np.repeat(j, hits)
+    rank = np.arange(len(j)) - np.repeat(np.cumsum(hits) - hits, hits)
+    i = order[np.repeat(first[kmer], hits) + rank]
+    e1 = np.frombuffer(E1, dtype=E1.typecode)
+    e2 = np.frombuffer(E2, dtype=E2.typecode)
+    agree = np.zeros(len(j), dtype=np.intp)
+    for t in range(k):
+        agree += e1[i + t] == e2[j + t]
+    return (j - i)[2 * agree > k].tolist()
+
+
+def Seed_windows(diags, margin, max_windows):
+    '''
+    Cluster seed diagonals that are within margin of each other.
+    return: a list of (diagonal, half-width) of the bands to be aligned,
+        for at most max_windows clusters with the most seeds.
+    '''
+    clusters = []
+    for d in sorted(diags):
+        if clusters and d - clusters[-1][1] <= margin:
+            clusters[-1][1] = d
+            clusters[-1][2] += 1
+        else:
+            clusters.append([d, d, 1])
+    clusters.sort(key=lambda c: -c[2])
+    return [((c[0] + c[1]) // 2, (c[1] - c[0] + 1) // 2 + margin)
+            for c in clusters[:max_windows]]
+
+
+def Manhattan_prefilter(S, param):
+    '''
+    Seed-and-filter alignment for long search regions.
+    Exact k-mer seeds with agreeing epi-states (Find_seeds) are clustered
+        by diagonal, and the banded dynamic programming is run around each
+        cluster, with param['seed_margin'] cells on both sides. The best
+        alignment over all bands is reported; the scores of cells outside
+        all bands are -Inf. If no seed is found, the full matrix is aligned.
+    S.seeds, S.windows and S.cells record the number of seeds, the number of
+        bands and the number of cells computed.
+    return: the updated S.
+    '''
+    S1, E1, S2, E2 = Oriented(S)
+    diags = Find_seeds(S1, E1, S2, E2, param['seed_k'],
+                       param['seed_max_occ'])
+    windows = Seed_windows(diags, param['seed_margin'], param['seed_windows'])
+    S.seeds = len(diags)
+    S.windows = len(windows)
+    if not windows:
+        Manhattan_np(S, param)
+        S.cells = len(S1) * len(S2)
+        return S
+
+    Na = float('-Inf')
+    swapped = len(S.S1) > len(S.S2)
+    diag = S.diag
+    band_param = dict(param)
+    band_param['all_prob'] = True
+    best = None
+    prob = None
+    cells = 0
+    for d, w in windows:
+        # Seeds are found in the orientation of the kernels.
+        S.diag = -d if swapped else d
+        band_param['band'] = w
+        Manhattan_np(S, band_param)
+        cells += S.cells
+        if best is None or S.L > best[0]:
+            best = (S.L, S.loc1, S.loc2, S.start_point, S.band_edge)
+        if prob is None:
+            prob = S.prob
+        else:
+            prob = [max(a, b) for a, b in zip(prob, S.prob)]
+    S.diag = diag
+    S.L, S.loc1, S.loc2, S.start_point, S.band_edge = best
+    S.cells = cells
+    scores = [f for f in prob if f != Na]
+    S.averagedL = sum(scores) / float(len(scores))
+    S.prob = prob if param['all_prob'] or param['hit_summary'] else []
     return S
 
 
-def prepareManhattanParams(S, params):
+def Oriented(S):
+    '''
+    Return the shorter region first, as the kernels do.
+    return: (S1, S1_epi, S2, S2_epi)
+    '''
+    if len(S.S1) <= len(S.S2):
+        return S.S1, S.S1_epi, S.S2, S.S2_epi
+    return S.S2, S.S2_epi, S.S1, S.S1_epi
+
+
+def Manhattan_batch(Slist, param):
+    '''
+    Fill the matrices of several region pairs in lockstep.
+    The pairs are padded to the longest lengths in the batch and each row of
+        all matrices is computed at once on (pair, column) arrays, using the
+        same operations as Manhattan_np. Padded columns lie to the right of
+        the last column of a pair and padded rows below its last row, so
+        they never feed back into the cells of the pair.
+    Slist: a list of HomoRegion objects with the same number of epi marks.
+        Pairs of similar lengths should be batched together to limit
+        padding.
+    With EpiFactors (more than EPI_DENSE_MARKS epi marks), there are no
+        query profiles to gather from, and the pairs are aligned one at a
+        time with Manhattan_np.
+    return: the updated Slist.
+    '''
+    if param['epi_factors'] is not None:
+        for S in Slist:
+            Manhattan_np(S, param)
+        return Slist
+    n_epi = Slist[0].n_epi
+    B = len(Slist)
+    oriented = [Oriented(S) for S in Slist]
+    m_arr = np.array([len(o[0]) for o in oriented], dtype=np.intp)
+    n_arr = np.array([len(o[2]) for o in oriented], dtype=np.intp)
+    m_max = int(m_arr.max())
+    n_max = int(n_arr.max())
+
+    precision = Kernel_precision([param], m_max, n_max)
+    # Query profiles and target columns, padded with zeros.
+    profile = None
+    sym2 = np.zeros((B, n_max), dtype=np.intp)
+    equil2 = None
+    for b, (b1, e1, b2, e2) in enumerate(oriented):
+        query = Query_profile(b1, e1, n_epi, [param], precision)[0]
+        if profile is None:
+            profile = np.zeros((B, m_max, query.shape[1]), dtype=query.dtype)
+            equil2 = np.zeros((B, n_max), dtype=query.dtype)
+        profile[b, :len(b1)] = query
+        columns = Target_columns(b2, e2, n_epi, [param], precision)
+        sym2[b, :len(b2)] = columns[0]
+        equil2[b, :len(b2)] = columns[1][0]
+    dtype = profile.dtype
+    Na = Kernel_array(float('-Inf'), precision)
+    init0 = 0
+    ent0_comp = Kernel_array(
+        param['log_lamb_mu'] + param['log_link_p'][0], precision)
+    half_diag_norm = Kernel_array(param['half_diag_norm'], precision)
+    diag_norm = Kernel_array(param['diag_norm'], precision)
+    log_lamb_beta = Kernel_array(param['log_lamb_beta'], precision)
+    if precision == "fixed":
+        ent2_step = log_lamb_beta - half_diag_norm
+    else:
+        ent2_step = Kernel_array(
+            param['log_lamb_beta'] - param['half_diag_norm'], precision)
+
+    lanes = np.arange(B)
+    cols = np.arange(n_max + 1)
+    step = (cols[1:] * ent2_step).astype(dtype)
+
+    manh3 = np.full((B, n_max + 1), init0, dtype=dtype)
+    st_row = np.zeros((B, n_max + 1), dtype=np.intp)
+    st_col = np.tile(cols, (B, 1))
+
+    last_col = np.full((B, m_max + 1), Na, dtype=dtype)
+    last_col_st_row = np.zeros((B, m_max + 1), dtype=np.intp)
+    last_col_st_col = np.zeros((B, m_max + 1), dtype=np.intp)
+    last_row = [None] * B
+
+    for i in range(1, m_max + 1):
+        ent0 = ent0_comp + manh3[:, 1:] - half_diag_norm
+        ent1 = np.take_along_axis(profile[:, i - 1], sym2, axis=1) + \
+            manh3[:, :-1] - equil2 - diag_norm
+        manh2 = Gap_scores(ent1, step, log_lamb_beta, half_diag_norm, Na,
+                           precision)
+        ent2 = log_lamb_beta + manh2[:, :-1] - half_diag_norm
+
+        up = ent0 >= np.maximum(ent1, ent2)
+        left = ~up & (ent2 > ent1)
+
+        new3 = np.empty((B, n_max + 1), dtype=dtype)
+        new3[:, 0] = init0
+        new3[:, 1:] = np.where(up, ent0, np.where(left, ent2, ent1))
+
+        new_row = np.empty((B, n_max + 1), dtype=np.intp)
+        new_col = np.empty((B, n_max + 1), dtype=np.intp)
+        new_row[:, 0] = i
+        new_col[:, 0] = 0
+        new_row[:, 1:] = np.where(up, st_row[:, 1:], st_row[:, :-1])
+        new_col[:, 1:] = np.where(up, st_col[:, 1:], st_col[:, :-1])
+        src = np.tile(cols, (B, 1))
+        src[:, 1:][left] = 0
+        src = np.maximum.accumulate(src, axis=1)
+        st_row = np.take_along_axis(new_row, src, axis=1)
+        st_col = np.take_along_axis(new_col, src, axis=1)
+        manh3 = new3
+
+        last_col[:, i] = manh3[lanes, n_arr]
+        last_col_st_row[:, i] = st_row[lanes, n_arr]
+        last_col_st_col[:, i] = st_col[lanes, n_arr]
+        for b in np.flatnonzero(m_arr == i):
+            n = n_arr[b]
+            last_row[b] = (Kernel_scores(manh3[b, :n + 1], precision).tolist(),
+                           list(zip(st_row[b, :n + 1].tolist(),
+                                    st_col[b, :n + 1].tolist())))
+
+    last_col = Kernel_scores(last_col, precision)
+    Na = float('-Inf')
+    for b, S in enumerate(Slist):
+        m = m_arr[b]
+        lc = last_col[b, :m + 1].tolist()
+        lc_st = [Na] + list(zip(last_col_st_row[b, 1:m + 1].tolist(),
+                                last_col_st_col[b, 1:m + 1].tolist()))
+        Summarize_scores(S, last_row[b][0], last_row[b][1], lc, lc_st, param)
+    return Slist
+
+
+def Batch_pairs(S, batch_size):
+    '''
+    Group region pairs of similar lengths for Manhattan_batch.
+    S: the list of region pairs.
+    return: a list of batches. Each batch is a list of indices in S.
+    '''
+    order = sorted(range(len(S)), key=lambda k: (
+        min(len(S[k].S1), len(S[k].S2)), max(len(S[k].S1), len(S[k].S2))))
+    return [order[k:k + batch_size] for k in range(0, len(order), batch_size)]
+
+
+# Attributes of HomoRegion computed by the worker processes. Only these are
+# sent back to the main process, not the sequences.
+RESULT_FIELDS = ("L", "averagedL", "loc1", "loc2", "start_point", "prob",
+                 "band_edge", "cells", "seeds", "windows", "S1_path",
+                 "S2_path", "S_match", "S1_epi_path", "S2_epi_path",
+                 "summary")
+
+# The parameter dictionary of a worker process, set once by Init_worker when
+# the process starts, or loaded by Load_param for the runs of a service.
+worker_param = None
+worker_param_key = None
+
+
+def Init_worker(param):
+    '''
+    Pool initializer. The parameters are sent to each worker process once,
+        instead of once per job.
+    '''
+    global worker_param
+    worker_param = param
+
+
+def Load_param(key):
+    '''
+    Load the parameters of a run of the service (see Serve) in a worker
+        process, unless they are already loaded.
+    key: the name of the file in which Manhattan_obj pickled the parameters.
+    '''
+    global worker_param, worker_param_key
+    if key != worker_param_key:
+        with open(key, "rb") as fin:
+            worker_param = pickle.load(fin)
+        worker_param_key = key
+
+
+def Result_record(S):
+    '''
+    The alignment result of S, as a tuple of the RESULT_FIELDS attributes.
+    '''
+    return tuple(getattr(S, f) for f in RESULT_FIELDS)
+
+
+def Apply_result(S, record):
+    '''
+    Copy a record built by Result_record into S.
+    '''
+    for f, value in zip(RESULT_FIELDS, record):
+        setattr(S, f, value)
+
+
+def prepareManhattanParams(S, params, todo):
+    '''
+    Split the region pairs to be aligned into jobs. A job is one pair, or
+        for the batch kernel, a batch of pairs within params['window']
+        consecutive pairs, so that its results are not held for long
+        before they are written. The parameters are not part of the jobs
+        (see Init_worker).
+    todo: the indices in S of the pairs to be aligned, in increasing order.
+    return: a list of jobs. Each job is a list of indices in S.
+    '''
+    if params['kernel'] != "batch":
+        return [[i] for i in todo]
     jobs = []
-    for entry in S:
-        job = dict()
-        job['S'] = entry
-        job['param'] = copy.deepcopy(params)
-        jobs.append(job)
+    for w0 in range(0, len(todo), params['window']):
+        window = todo[w0:w0 + params['window']]
+        jobs += [[window[k] for k in batch] for batch in
+                 Batch_pairs([S[i] for i in window], params['batch_size'])]
     return jobs
 
 
+def Pair_cost(S, param):
+    '''
+    The estimated cost of aligning a region pair: the number of cells of
+        the alignment matrix, or of its band for banded alignment.
+    '''
+    m = min(len(S.S1), len(S.S2))
+    n = max(len(S.S1), len(S.S2))
+    band = Band_of(S, m, n, param)
+    if band:
+        return m * min(n, 2 * band[1] + 1)
+    return m * n
+
+
+def Schedule_jobs(costs, p_num, groups=None):
+    '''
+    Order the jobs from the most to the least expensive and group them into
+        chunks. The chunks are handed out one at a time to the workers that
+        become idle, so that the expensive jobs start first and the cheap
+        ones fill the gaps at the end.
+    A chunk is closed as soon as its cost reaches 1 / (8 * p_num) of the
+        total cost: expensive jobs make a chunk of their own, while cheap
+        jobs are grouped to save inter-process communication.
+    costs: the estimated cost of each job.
+    groups: if given, a key of each job. Jobs with the same key are kept
+        next to each other, so that they tend to share a chunk and a
+        worker, and the groups are ordered by their total cost.
+    return: a list of chunks. Each chunk is a list of job indices.
+    '''
+    order = sorted(range(len(costs)), key=lambda k: -costs[k])
+    if groups is not None:
+        group_cost = {}
+        for k in order:
+            group_cost[groups[k]] = group_cost.get(groups[k], 0) + costs[k]
+        # Stable, so that the jobs of a group stay in decreasing cost.
+        first = {}
+        for k in order:
+            first.setdefault(groups[k], len(first))
+        order.sort(key=lambda k: (-group_cost[groups[k]], first[groups[k]]))
+    target = sum(costs) / (8.0 * p_num)
+    chunks = []
+    chunk = []
+    chunk_cost = 0
+    for k in order:
+        chunk.append(k)
+        chunk_cost += costs[k]
+        if chunk_cost >= target:
+            chunks.append(chunk)
+            chunk = []
+            chunk_cost = 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
 def manhattanWrapper(arg):
-    return Manhattan(arg['S'], arg['param'])
+    '''
+    Align a job with every parameter set of worker_param.
+    return: a list of result records, one per parameter set, or for the
+        batch kernel, a list of such lists, one per region pair.
+    '''
+    params = worker_param
+    param = params[0]
+    if param['kernel'] == "batch":
+        records = []
+        for set_param in params:
+            Slist = Manhattan_batch(arg, set_param)
+            if set_param['align_path']:
+                for S in Slist:
+                    Align_path(S, set_param)
+            records.append([Result_record(S) for S in Slist])
+        records = [list(pair_records) for pair_records in zip(*records)]
+        if param['hit_summary']:
+            records = [Hit_summary(S, pair_records, params)
+                       for S, pair_records in zip(arg, records)]
+        return records
+    return Align_pair(arg, params)
+
+
+def Register_kernel(name, align, sets=False):
+    '''
+    Add a kernel backend to KERNELS.
+    align: align(S, param) fills the matrices of a region pair and records
+        the results in S, like Manhattan. With sets=True, align(S, params)
+        aligns the pair with a list of parameter sets and returns a list of
+        result records, like Manhattan_np_sets.
+    '''
+    if sets:
+        KERNELS[name] = align
+        return
+
+    def align_sets(S, params):
+        records = []
+        for param in params:
+            align(S, param)
+            records.append(Result_record(S))
+        return records
+    KERNELS[name] = align_sets
 
 
-def Manhattan_obj(S, p_num, param):
+def Kernel_backend(name):
+    '''
+    The kernel backend of a name: a registered kernel, or "module:function"
+        for the function of a module that fills the matrices of a region
+        pair like Manhattan. The module is imported on first use in each
+        process, so it must be importable by the worker processes too.
+    return: a function aligning a region pair with a list of parameter sets
+        (see Register_kernel).
+    '''
+    if name not in KERNELS:
+        module, sep, function = name.partition(":")
+        if not sep:
+            raise Exception(303, "Unknown kernel: " + name)
+        try:
+            align = getattr(importlib.import_module(module), function)
+        except (ImportError, AttributeError) as e:
+            raise Exception(303, "Cannot load the kernel " + name + ": " +
+                            str(e))
+        Register_kernel(name, align)
+    return KERNELS[name]
+
+
+Register_kernel("python", Manhattan)
+# All parameter sets in one traversal of the matrices.
+Register_kernel("numpy", Manhattan_np_sets, sets=True)
+# Single pairs of the batch kernel (see Align_pair).
+Register_kernel("batch", Manhattan_np_sets, sets=True)
+
+
+def Align_pair(S, params):
+    '''
+    Align a region pair with every parameter set of params. Pairs of the
+        batch kernel are aligned with the numpy kernel, which gives the same
+        results.
+    return: a list of result records, one per parameter set.
+    '''
+    param = params[0]
+    if param['band'] is not None and S.diag is not None:
+        records = Manhattan_np_sets(S, params)
+    elif param['prefilter']:
+        records = []
+        for set_param in params:
+            Manhattan_prefilter(S, set_param)
+            records.append(Result_record(S))
+    else:
+        records = Kernel_backend(param['kernel'])(S, params)
+    if param['align_path']:
+        for k, set_param in enumerate(params):
+            Apply_result(S, records[k])
+            Align_path(S, set_param)
+            records[k] = Result_record(S)
+    if param['hit_summary']:
+        records = Hit_summary(S, records, params)
+    return records
+
+
+def Percentile(values, q):
+    '''
+    The q-th percentile of values, interpolated linearly between the
+        closest ranks like numpy.percentile.
+    '''
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100.0
+    lo = int(pos)
+    if lo == pos:
+        return values[lo]
+    return values[lo] + (values[lo + 1] - values[lo]) * (pos - lo)
+
+
+def Noise_bounds(scores, start):
+    '''
+    Signal-to-noise bounds of a score vector: the scores from position
+        start on are split into bins of NOISE_BIN scores (the last bin
+        takes the remainder), and the 75th percentile of the bin maxima and
+        the 25th percentile of the bin minima are returned.
+    return: [upper, lower], or [None, None] if there are no such scores.
+    '''
+    if start >= len(scores):
+        return [None, None]
+    bins = [scores[i:i + NOISE_BIN] for i in
+            range(start, len(scores) - NOISE_BIN, NOISE_BIN)]
+    bins.append(scores[start + NOISE_BIN * len(bins):])
+    return [Percentile([max(b) for b in bins], 75),
+            Percentile([min(b) for b in bins], 25)]
+
+
+def Hit_summary(S, records, params):
+    '''
+    Summarize the score vectors of a region pair for the enhancer mode of
+        server_agent.py, which would otherwise read the vectors back from
+        the -O files. Only the target part of each vector (the first
+        len(S.S2) scores) is used.
+    The summary of a parameter set is a list with, for each other set in
+        order, the maximal score of this set from HIT_WINDOW positions
+        before to HIT_WINDOW - 1 positions after the hit (loc2) of the
+        other set, followed by the bounds of Noise_bounds, starting at
+        position len(S.S1). Values without any score are None.
+    records: the result records of the pair, one per parameter set.
+    return: the records with the summaries. The score vectors are dropped
+        unless param['all_prob'] is set.
+    '''
+    records = [dict(zip(RESULT_FIELDS, record)) for record in records]
+    for k, record in enumerate(records):
+        scores = record['prob'][:len(S.S2)]
+        summary = []
+        for j, other in enumerate(records):
+            if j != k:
+                pos = other['loc2']
+                window = scores[max(0, pos - HIT_WINDOW):pos + HIT_WINDOW]
+                summary.append(max(window) if window else None)
+        record['summary'] = summary + Noise_bounds(scores, len(S.S1))
+    for param, record in zip(params, records):
+        if not param['all_prob']:
+            record['prob'] = []
+    return [tuple(record[f] for f in RESULT_FIELDS) for record in records]
+
+
+def manhattanChunk(arg):
+    '''
+    Run a chunk of jobs in a worker process.
+    arg: (key, sent, chunk). key is None, or the parameter file of a run of
+        the service (see Load_param). sent is the time.time() at which the
+        chunk was handed to the pool. chunk is a list of (job index, job)
+        tuples.
+    return: the process id, the busy time in seconds and a list of
+        (job index, result, queue wait, time) tuples. The queue wait of a
+        job runs from sent to the start of the job, and includes the jobs
+        before it in the chunk.
+    '''
+    key, sent, chunk = arg
+    t0 = time.perf_counter()
+    if key is not None:
+        Load_param(key)
+    results = []
+    for k, job in chunk:
+        wait = time.time() - sent
+        t1 = time.perf_counter()
+        res = manhattanWrapper(job)
+        results.append((k, res, wait, time.perf_counter() - t1))
+    return os.getpid(), time.perf_counter() - t0, results
+
+
+def Param_digest(param):
+    '''
+    A digest of the values of a parameter set that change the results of
+        an alignment, for PairCache.
+    '''
+    keys = ['score_table', 'equil_row', 'epi_factors', 'log_lamb_mu',
+            'log_link_p', 'log_lamb_beta', 'half_diag_norm', 'kernel',
+            'precision', 'band', 'prefilter', 'seed_k', 'seed_margin',
+            'seed_windows', 'seed_max_occ']
+    return hashlib.sha256(
+        repr([param[k] for k in keys]).encode()).hexdigest()
+
+
+class PairCache:
+    '''
+    Persistent cache of the results of region pairs across runs, in a
+        directory. An entry is keyed by a digest of the encoded sequences
+        and epi-states of a pair and of the parameter set (Param_digest),
+        and holds the result record of the pair (see Result_record).
+    Score vectors and alignment paths are only stored if they were
+        requested; the file name records which ones an entry holds.
+    Entries are written atomically, so several runs can share a cache.
+        Reading an entry updates its modification time, and evict() removes
+        the least recently used entries until the cache fits in max_bytes.
+        put() keeps a running total of the size of the cache, and evicts
+        down to CACHE_LOW_WATER of max_bytes whenever it is exceeded, so
+        that a run never grows the cache much beyond its limit.
+    hits and misses count the lookups of has(): one per region pair and
+        parameter set, whether or not the other sets of the pair are found.
+    '''
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        # Size of the cache as of the last scan, plus the entries put since.
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, S, set_digest):
+        h = hashlib.sha256()
+        h.update(repr((S.n_epi, S.diag, S.S1_epi.typecode, len(S.S1),
+                       len(S.S2), set_digest)).encode())
+        for a in (S.S1, S.S1_epi, S.S2, S.S2_epi):
+            h.update(a.tobytes())
+        return h.hexdigest()
+
+    def _file(self, key, has_prob, has_path):
+        return os.path.join(self.path, key[:2], key + "." +
+                            str(int(has_prob)) + str(int(has_path)))
+
+    def _files(self, key, need_prob, need_path):
+        # Entries that hold at least what is needed.
+        return [self._file(key, has_prob, has_path)
+                for has_prob in sorted({need_prob, True})
+                for has_path in sorted({need_path, True})]
+
+    def has(self, key, need_prob, need_path):
+        for f_name in self._files(key, need_prob, need_path):
+            try:
+                os.utime(f_name)
+                self.hits += 1
+                return True
+            except OSError:
+                pass
+        self.misses += 1
+        return False
+
+    def get(self, key, need_prob, need_path):
+        '''
+        return: the result record, without the score vector or the path if
+            they are not needed, or None if there is no such entry.
+        '''
+        for f_name in self._files(key, need_prob, need_path):
+            try:
+                with open(f_name, "rb") as fin:
+                    record = dict(zip(RESULT_FIELDS, pickle.load(fin)))
+            except (OSError, EOFError, pickle.UnpicklingError):
+                continue
+            if not need_prob:
+                record['prob'] = []
+            if not need_path:
+                record.update(S1_path="", S2_path="", S_match="",
+                              S1_epi_path={}, S2_epi_path={})
+            return tuple(record[f] for f in RESULT_FIELDS)
+        return None
+
+    def put(self, key, record, has_prob, has_path):
+        f_name = self._file(key, has_prob, has_path)
+        os.makedirs(os.path.dirname(f_name), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(f_name), delete=False) as fout:
+            pickle.dump(record, fout)
+            size = fout.tell()
+        os.replace(fout.name, f_name)
+        if self.size is None or self.size + size > self.max_bytes:
+            self.evict(int(CACHE_LOW_WATER * self.max_bytes))
+        else:
+            self.size += size
+
+    def evict(self, max_bytes=None):
+        '''
+        Remove the least recently used entries until the cache fits in
+            max_bytes (default: self.max_bytes), if it exceeds
+            self.max_bytes.
+        '''
+        entries = []
+        for d in os.scandir(self.path):
+            if d.is_dir():
+                for f in os.scandir(d.path):
+                    st = f.stat()
+                    entries.append((st.st_mtime, st.st_size, f.path))
+        total = sum(e[1] for e in entries)
+        if total > self.max_bytes:
+            if max_bytes is None:
+                max_bytes = self.max_bytes
+            for mtime, size, f_name in sorted(entries):
+                if total <= max_bytes:
+                    break
+                try:
+                    os.unlink(f_name)
+                except OSError:
+                    continue
+                total -= size
+                self.evicted += 1
+        self.size = total
+
+
+def Collect_results(p, S_sets, params, key, stats, emit=None, cache=None):
+    '''
+    Schedule the jobs of the region pairs on the pool p and copy the results
+        of each parameter set into its list of S_sets.
+    All the jobs are ordered by Schedule_jobs, and their chunks are handed
+        to the pool in that order while fewer than param['window'] results
+        wait for the pairs before them and the chunks in flight. Beyond
+        that, jobs are handed out in the input order from the first pair
+        that is not done, within param['window'] pairs of it, so that about
+        twice this many results at most are held. Without emit, nothing is
+        written until the end and all the chunks are handed out by cost.
+    key: the parameter file of a run of the service, or None if the
+        parameters were given to the pool initializer.
+    emit: if given, emit(i) is called for each pair index i in the input
+        order, as soon as the pairs 0 to i are done.
+    cache: a PairCache. Pairs found in it are not aligned; their results
+        are read from the cache when they are emitted, or at the end if
+        emit is None. The results of the other pairs are added to it.
+    '''
+    S = S_sets[0]
+    param = params[0]
+    done = [False] * len(S)
+    todo = list(range(len(S)))
+    if cache is not None:
+        set_keys = [Param_digest(set_param) for set_param in params]
+        if param['hit_summary']:
+            # The summaries of a set depend on the hits of the other sets.
+            set_keys = [hashlib.sha256(
+                repr((k, set_keys)).encode()).hexdigest()
+                for k in range(len(params))]
+        keys = [[cache.key(pair, k) for k in set_keys] for pair in S]
+        need = (bool(param['all_prob']), bool(param['align_path']))
+        # Every set is looked up, so that the hits and misses of the cache
+        # count the (pair, set) entries.
+        cached = [i for i in todo if all([cache.has(k, *need)
+                                          for k in keys[i]])]
+        cached_set = set(cached)
+        todo = [i for i in todo if i not in cached_set]
+        for i in cached:
+            done[i] = None
+    next_out = [0]
+
+    def Emit():
+        # Cached pairs (done is None) are read when their turn comes.
+        while next_out[0] < len(S) and done[next_out[0]] is not False:
+            i = next_out[0]
+            if done[i] is None:
+                records = [cache.get(k, *need) for k in keys[i]]
+                if None in records:
+                    # Evicted by another run in the meantime.
+                    records = Align_pair(S[i], params)
+                for S_set, record in zip(S_sets, records):
+                    Apply_result(S_set[i], record)
+                done[i] = True
+            else:
+                state['held'] -= 1
+            if emit is not None:
+                emit(i)
+            next_out[0] += 1
+
+    jobs = prepareManhattanParams(S, param, todo)
+    costs = [sum(Pair_cost(S[i], param) for i in job) for job in jobs]
+    groups = None
+    if param['kernel'] != "batch":
+        # Pairs that share a query or a target share its profile or its
+        # columns in a worker.
+        group_keys = Group_keys(S, todo)
+        groups = [group_keys[job[0]] for job in jobs]
+    chunks = Schedule_jobs(costs, stats['p_num'], groups)
+    target = sum(costs) / (8.0 * stats['p_num'])
+    # The jobs in the input order, for when the reorder buffer is full.
+    by_pos = sorted(range(len(jobs)), key=lambda k: min(jobs[k]))
+    limit = param['window'] if emit is not None else float('Inf')
+    sent = [False] * len(jobs)
+    state = {'chunk': 0, 'pos': 0, 'sent': 0, 'held': 0, 'running': {}}
+    arrived = queue.Queue()
+
+    def Job(k):
+        if param['kernel'] == "batch":
+            return [S[i] for i in jobs[k]]
+        return S[jobs[k][0]]
+
+    def Next_chunk():
+        running = state['running']
+        if state['held'] + sum(running.values()) < limit:
+            while state['chunk'] < len(chunks):
+                chunk = [k for k in chunks[state['chunk']] if not sent[k]]
+                state['chunk'] += 1
+                if chunk:
+                    return chunk
+            return []
+        # The job of the first pair that is not done, and the jobs after it
+        # whose results can be held.
+        chunk = []
+        cost = 0
+        while state['pos'] < len(by_pos) and cost < target:
+            k = by_pos[state['pos']]
+            if not sent[k]:
+                if min(jobs[k]) > next_out[0] and \
+                        max(jobs[k]) >= next_out[0] + limit:
+                    break
+                chunk.append(k)
+                cost += costs[k]
+            state['pos'] += 1
+        return chunk
+
+    def Dispatch():
+        # Two chunks per worker keep the workers busy between results.
+        while len(state['running']) < 2 * stats['p_num']:
+            chunk = Next_chunk()
+            if not chunk:
+                return
+            for k in chunk:
+                sent[k] = True
+            c = state['sent']
+            state['sent'] += 1
+            state['running'][c] = sum(len(jobs[k]) for k in chunk)
+            p.apply_async(
+                manhattanChunk,
+                ((key, time.time(), [(k, Job(k)) for k in chunk]),),
+                callback=lambda res, c=c: arrived.put((c, res)),
+                error_callback=lambda err, c=c: arrived.put((c, err)))
+
+    Emit()
+    Dispatch()
+    while state['running']:
+        c, res = arrived.get()
+        del state['running'][c]
+        if isinstance(res, BaseException):
+            raise res
+        pid, busy, results = res
+        worker = stats['workers'].setdefault(pid, [0, 0, 0.0])
+        worker[0] += len(results)
+        worker[1] += sum(costs[k] for k, res, wait, seconds in results)
+        worker[2] += busy
+        for k, res, wait, seconds in results:
+            if param['kernel'] != "batch":
+                res = [res]
+            # Put the pairs back in the input order.
+            for i, records in zip(jobs[k], res):
+                # The pairs of a batch share its time by their costs.
+                stats['pairs'][i] = (pid, wait, seconds * Pair_cost(
+                    S[i], param) / max(costs[k], 1))
+                for S_set, record in zip(S_sets, records):
+                    Apply_result(S_set[i], record)
+                done[i] = True
+                state['held'] += 1
+                if cache is not None:
+                    for cache_key, record in zip(keys[i], records):
+                        cache.put(cache_key, record, *need)
+        Emit()
+        Dispatch()
+
+
+def Manhattan_obj(S_sets, p_num, params, pool=None, emit=None, cache=None):
     '''
     Distribute region pairs to difference processes for parallel computing.
-    x: the parameter vector.
-    S: the list of region pairs. Each element is a HomoRegion object.
-    e_dict: the dictionary of equilibrium probabilities.
-    weights: the weights vector.
-    return: None. The function will update the S list directly.
+    The jobs are scheduled by Schedule_jobs from their estimated costs, and
+        the results are put back in the input order.
+    S_sets: one list of region pairs per parameter set. Each element is a
+        HomoRegion object. The lists hold the same pairs; the jobs are made
+        from the first one.
+    p_num: the number of processes.
+    params: the list of parameter dictionaries, sent to each process once.
+        Each job is aligned with all of them.
+    pool: the pool of a service (see Serve), or None to start p_num
+        processes for this run. The parameters are then pickled to a
+        temporary file, which each worker loads once.
+    emit: called with each pair index in the input order as soon as its
+        results are available (see Collect_results).
+    cache: a PairCache consulted before the pairs are dispatched.
+    return: a dictionary of worker statistics: wall time, p_num, for each
+        worker process id, [jobs, cost, busy time], and for each index of an
+        aligned pair, (process id, queue wait, time) (see manhattanChunk).
+        The function will update the S_sets lists directly.
     '''
-    with get_context("spawn").Pool(p_num) as p:
+    stats = {'p_num': p_num, 'workers': {}, 'pairs': {}}
+    t0 = time.perf_counter()
+    if pool is not None:
+        with tempfile.NamedTemporaryFile(suffix=".param") as fpara:
+            pickle.dump(params, fpara)
+            fpara.flush()
+            Collect_results(pool, S_sets, params, fpara.name, stats,
+                            emit, cache)
+        stats['wall'] = time.perf_counter() - t0
+        return stats
+    with get_context("spawn").Pool(
+            p_num, initializer=Init_worker, initargs=(params,)) as p:
         try:
-            jobs = prepareManhattanParams(S, param)
-            mp_queue = p.map(manhattanWrapper, jobs)
-            S[:] = mp_queue
+            Collect_results(p, S_sets, params, None, stats, emit, cache)
             p.close()
             p.join()
         except Exception as err:
@@ -817,20 +2884,131 @@ def Manhattan_obj(S, p_num, param):
             print(err.args[1], file=sys.stderr)
             sys.exit(err.args[0])
         # Manhattan(S[0], x)
-    return
-
+    stats['wall'] = time.perf_counter() - t0
+    return stats
 
-def Main():
-    args = ParseArg()
-    S, maxlen1, maxlen2, ave1, ave2 = ReadInput(args.Input)
 
-    param = dict()
-
-    p_num = args.process_num
+def Worker_stats(stats, fname):
+    '''
+    Report the utilization of the worker processes, i.e. the busy time of
+        all workers over p_num times the wall time of Manhattan_obj. The
+        numbers of each worker are written to fname if it is not empty.
+    '''
+    busy = sum(w[2] for w in stats['workers'].values())
+    if fname:
+        with open(fname, "w") as fout:
+            print("\t".join(["pid", "jobs", "cells", "busy"]), file=fout)
+            for pid, w in sorted(stats['workers'].items()):
+                print("\t".join([str(f) for f in [pid] + w]), file=fout)
+    print("[EpiAlignment]Workers: " + str(len(stats['workers'])) + " of " +
+          str(stats['p_num']) + " processes received jobs. Wall time " +
+          str(round(stats['wall'], 2)) + " s, busy time " +
+          str(round(busy, 2)) + " s, utilization " +
+          str(round(100.0 * busy / max(stats['wall'] * stats['p_num'],
+                                       1e-9), 2)) + "%.", file=sys.stderr)
+
+
+def Pair_stats(S, stats, fname, offset=0):
+    '''
+    Report the throughput of a run and its slowest region pairs. For each
+        pair aligned by the workers (pairs read from the cache are left
+        out), one JSON record with its index in the input, name, matrix
+        size (m rows, n columns), cells computed, time and queue wait in
+        seconds and worker process id is written to the lines of fname.
+    offset: the index in the input of S[0].
+    '''
+    pairs = sorted(stats['pairs'].items())
+    cells = 0
+    with open(fname, "w") as fout:
+        for i, (pid, wait, seconds) in pairs:
+            pair = S[i]
+            m = min(len(pair.S1), len(pair.S2))
+            n = max(len(pair.S1), len(pair.S2))
+            pair_cells = pair.cells or m * n
+            cells += pair_cells
+            print(json.dumps({"index": offset + i, "name": pair.name,
+                              "m": m, "n": n, "cells": pair_cells,
+                              "seconds": seconds, "worker": pid,
+                              "wait": wait}), file=fout)
+    times = sorted(seconds for i, (pid, wait, seconds) in pairs)
+    if not times:
+        return
+    slowest = sorted(pairs, key=lambda p: -p[1][2])[:5]
+    print("[EpiAlignment]Pairs: " + str(len(pairs)) + " aligned, " +
+          str(cells) + " cells in " + str(round(stats['wall'], 2)) +
+          " s (" + str(round(cells / max(stats['wall'], 1e-9))) +
+          " cells/s). Time per pair: median " +
+          str(round(times[len(times) // 2], 4)) + " s, 99th percentile " +
+          str(round(times[int(0.99 * (len(times) - 1))], 4)) +
+          " s. Slowest: " + ", ".join(
+              S[i].name + " (" + str(round(p[2], 4)) + " s)"
+              for i, p in slowest) + ".", file=sys.stderr)
+
+
+def Prefilter_stats(S, fname):
+    '''
+    Report the cells pruned by --prefilter. Per-pair numbers are written to
+        fname if it is not empty.
+    '''
+    total = 0
+    computed = 0
+    no_seed = 0
+    if fname:
+        fout = open(fname, "w")
+        print("\t".join(["name", "len1", "len2", "seeds", "windows",
+                         "cells", "total_cells"]), file=fout)
+    for pair in S:
+        pair_total = len(pair.S1) * len(pair.S2)
+        total += pair_total
+        computed += pair.cells
+        if pair.windows == 0:
+            no_seed += 1
+        if fname:
+            print("\t".join([str(f) for f in [
+                pair.name, len(pair.S1), len(pair.S2), pair.seeds,
+                pair.windows, pair.cells, pair_total]]), file=fout)
+    if fname:
+        fout.close()
+    print("[EpiAlignment]Prefilter: computed " + str(computed) + " of " +
+          str(total) + " cells (" +
+          str(round(100.0 * (total - computed) / max(total, 1), 2)) +
+          "% pruned). " + str(no_seed) + " pairs without seeds were " +
+          "aligned in full.", file=sys.stderr)
+
+
+def Result_line(pair, param):
+    '''
+    Format the alignment result of a region pair for the output file.
+    '''
+    fields = [
+        pair.name,
+        str(pair.L),
+        str(pair.averagedL),
+        str(pair.start_point[0]),
+        str(pair.loc1),
+        str(pair.start_point[1]),
+        str(pair.loc2)
+    ]
+    if param['band'] is not None:
+        if pair.band_edge is None:
+            fields.append(".")
+        else:
+            fields.append(str(int(pair.band_edge)))
+    if param['hit_summary']:
+        fields += ["." if f is None else str(f) for f in pair.summary]
+    return "\t".join(fields)
 
-    param['all_prob'] = args.out_allvec
 
-    x, weights, equil_dict, log_equil_dict = ReadParameters(args.equil_file)
+def Model_param(param, model, n_epi, ave1, ave2):
+    '''
+    Add the model parameters and the score tables to the parameter
+        dictionary.
+    model: the parameters as returned by ReadParameters.
+    n_epi: number of epi marks.
+    ave1, ave2: the average lengths of the two regions of the pairs.
+    return: None. param will be updated directly.
+    '''
+    x, weights, equil_dict, log_equil_dict = model
 
     mu = x[1]
     lamb = mu * (ave1 + ave2) / (ave1 + ave2 + 2)
@@ -856,54 +3034,636 @@ def Main():
         log_link_p[1], log_link_p[2]) + param['log_lamb_mu']
     param['half_diag_norm'] = 0.5 * param['diag_norm']
 
+    # Transition_matrix
+    param['Log_transition_dic'] = Trans_matrix(
+        n_epi, x, equil_dict, weights)
+    if n_epi > EPI_DENSE_MARKS:
+        # The 2^n_epi epi-states are not enumerated in pairs.
+        param['epi_factors'] = EpiFactors(
+            n_epi, param, log_equil_dict, weights)
+        param['score_table'] = None
+        param['equil_row'] = None
+        return
+    param['epi_factors'] = None
+
     # Equilibrium probabilities
     S_epi, log_S_epi = Epi_equilibrium(
-        len(S[0].S1[0]) - 1, equil_dict, log_equil_dict, weights)
+        n_epi, equil_dict, log_equil_dict, weights)
     param['log_equil_mat'] = Equilibrium_matrix(
         log_equil_dict, log_S_epi, weights)
 
-    # Transition_matrix
-    param['Log_transition_dic'] = Trans_matrix(
-        len(S[0].S1[0]) - 1, x, equil_dict, weights)
     param['Log_trans_prod'] = Combine_epi_trans(
         param['Log_transition_dic'], log_S_epi
     )
+    param['score_table'] = Pair_score_table(n_epi, param)
+    param['equil_row'] = Symbol_equil(n_epi, param)
+    if param['align_path']:
+        param['z_table'] = Pair_z_table(n_epi, param)
+
 
+class ResultWriter:
+    '''
+    Write the results of the region pairs in the input order, one pair at a
+        time as Manhattan_obj makes them available.
+    For each parameter set, the output file, the score vectors
+        (param['all_prob']) and the alignment paths (param['align_path'])
+        are written. With --sweep (axes and points given), the output is a
+        single table with one line per region pair and parameter
+        combination: the values of the swept parameters followed by the
+        fields of Result_line.
+    The score vectors are written as text, or with vec_format "binary" to
+        a binary store (see ScoreVectors.py). The score vectors and the
+        paths of a pair are released once written.
+    If a checkpoint file is attached (see Open_checkpoint), the results of
+        each pair are also appended to it, and it is flushed to disk every
+        interval seconds.
+    '''
+
+    def __init__(self, S_sets, params, out_names, axes=None, points=None,
+                 vec_format="text"):
+        self.S_sets = S_sets
+        self.params = params
+        self.points = points
+        self.checkpoint = None
+        self.interval = 0
+        self.last_save = time.time()
+        self.fout = [open(f_name, "w") for f_name in out_names]
+        self.vec_format = vec_format
+        if vec_format == "binary":
+            self.fout2 = [VectorWriter(p['all_prob']) if p['all_prob']
+                          else None for p in params]
+        else:
+            self.fout2 = [open(p['all_prob'], "w") if p['all_prob']
+                          else None for p in params]
+        self.fpath = [open(p['align_path'], "w") if p['align_path'] else None
+                      for p in params]
+        if points is not None:
+            header = ["name", "set"] + [a[0] for a in axes] + \
+                ["L", "averagedL", "start1", "end1", "start2", "end2"]
+            if params[0]['band'] is not None:
+                header.append("band_edge")
+            print("\t".join(header), file=self.fout[0])
+
+    def write(self, i):
+        '''
+        Write the results of the i-th region pair.
+        '''
+        if self.checkpoint is not None:
+            pickle.dump((i, self.S_sets[0][i].name,
+                         [Result_record(S_set[i]) for S_set in self.S_sets]),
+                        self.checkpoint)
+            if time.time() - self.last_save >= self.interval:
+                self.save()
+        for k, param in enumerate(self.params):
+            pair = self.S_sets[k][i]
+            if self.points is None:
+                print(Result_line(pair, param), file=self.fout[k])
+            else:
+                fields = Result_line(pair, param).split("\t")
+                print("\t".join(fields[:1] + [str(k)] +
+                                [str(v) for v in self.points[k]] +
+                                fields[1:]), file=self.fout[0])
+            if self.fout2[k] and self.vec_format == "binary":
+                self.fout2[k].write(pair.name, pair.prob)
+                self.fout2[k].flush()
+                pair.prob = []
+            elif self.fout2[k]:
+                print(",".join([str(f) for f in [pair.name] + pair.prob]),
+                      file=self.fout2[k])
+                self.fout2[k].flush()
+                pair.prob = []
+            if self.fpath[k]:
+                Print_path(pair, self.fpath[k])
+                self.fpath[k].flush()
+                pair.S1_path = ""
+                pair.S2_path = ""
+                pair.S_match = ""
+                pair.S1_epi_path = {}
+                pair.S2_epi_path = {}
+        for fout in self.fout:
+            fout.flush()
+
+    def save(self):
+        '''
+        Flush the checkpoint file to disk.
+        '''
+        self.checkpoint.flush()
+        os.fsync(self.checkpoint.fileno())
+        self.last_save = time.time()
+
+    def close(self):
+        for fout in self.fout + self.fout2 + self.fpath:
+            if fout is not None:
+                fout.close()
+        if self.checkpoint is not None:
+            self.save()
+            self.checkpoint.close()
+
+
+def Run_digest(args):
+    '''
+    A digest of the input file, the parameter files and the options that
+        change the results of a run, identifying its checkpoint.
+    '''
+    h = hashlib.sha256()
+    for f_name in [args.Input] + args.equil_file + \
+            ([args.sweep] if args.sweep else []):
+        with open(f_name, "rb") as fin:
+            for block in iter(lambda: fin.read(1 << 20), b""):
+                h.update(block)
+        h.update(b"\0")
+    options = [args.kernel, args.precision, args.band, args.prefilter is None,
+               args.seed_k, args.seed_margin, args.seed_windows,
+               args.seed_max_occ,
+               bool(args.out_allvec), bool(args.align_path), args.hit_summary]
+    h.update(repr(options).encode())
+    return h.hexdigest()
+
+
+def Open_checkpoint(fname, digest, S_sets, writer, resume):
+    '''
+    Attach a checkpoint file to writer. If resume is set and fname was
+        written for the same digest (see Run_digest), the region pairs saved
+        in it are put back in S_sets and written again by writer, and new
+        results are appended after them. Otherwise the file is started over.
+    Pairs are saved in the input order, so the saved pairs are always the
+        first ones. A record cut short by an interruption is discarded, with
+        a warning.
+    return: the number of region pairs read from the checkpoint.
+    '''
+    n_done = 0
+    end = 0
+    if resume and os.path.exists(fname):
+        size = os.path.getsize(fname)
+        matched = False
+        try:
+            with open(fname, "rb") as fin:
+                if pickle.load(fin) == digest:
+                    matched = True
+                    end = fin.tell()
+                    while n_done < len(S_sets[0]) and end < size:
+                        i, name, records = pickle.load(fin)
+                        if i != n_done or name != S_sets[0][i].name:
+                            break
+                        for S_set, record in zip(S_sets, records):
+                            Apply_result(S_set[i], record)
+                        writer.write(i)
+                        n_done += 1
+                        end = fin.tell()
+                else:
+                    print("[EpiAlignment]The checkpoint " + fname + " was " +
+                          "written for another input or other parameters. " +
+                          "Starting over.", file=sys.stderr)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError,
+                TypeError) as err:
+            if not matched:
+                print("[EpiAlignment]The checkpoint " + fname + " could " +
+                      "not be read (" + str(err) + "). Starting over.",
+                      file=sys.stderr)
+        if matched and end < size:
+            print("[EpiAlignment]The checkpoint " + fname + " is " +
+                  "incomplete after " + str(n_done) + " region pairs. The " +
+                  "rest of it is discarded.", file=sys.stderr)
+    fckpt = open(fname, "r+b" if end > 0 else "wb")
+    fckpt.truncate(end)
+    fckpt.seek(end)
+    if end == 0:
+        pickle.dump(digest, fckpt)
+    writer.checkpoint = fckpt
+    writer.save()
+    return n_done
+
+
+def Check_precision(S, p_num, param, sample_size, out_name, pool=None):
+    '''
+    Align a sample of the region pairs with param['precision'] and with
+        float64, and compare the results. The python kernel is replaced by
+        the numpy kernel.
+    sample_size: the number of pairs, evenly spread over S.
+    out_name: the file to which the results of each pair are written.
+    '''
+    sample = S[::max(1, len(S) // sample_size)][:sample_size]
+    if param['kernel'] == "python":
+        param = dict(param, kernel="numpy")
+    base_param = dict(param, precision="float64")
+    S_base = [copy.copy(pair) for pair in sample]
+    S_test = [copy.copy(pair) for pair in sample]
+    Manhattan_obj([S_base], p_num, [base_param], pool)
+    Manhattan_obj([S_test], p_num, [param], pool)
+
+    max_diff = 0.0
+    max_ave_diff = 0.0
+    moved = 0
+    with open(out_name, "w") as fout:
+        print("\t".join(["name", "L_float64", "L_" + param['precision'],
+                         "diff", "pos_float64", "pos_" + param['precision'],
+                         "moved"]), file=fout)
+        for base, test in zip(S_base, S_test):
+            diff = abs(test.L - base.L)
+            max_diff = max(max_diff, diff)
+            max_ave_diff = max(max_ave_diff,
+                               abs(test.averagedL - base.averagedL))
+            pos = [",".join([str(base.start_point[0]), str(base.loc1),
+                             str(base.start_point[1]), str(base.loc2)]),
+                   ",".join([str(test.start_point[0]), str(test.loc1),
+                             str(test.start_point[1]), str(test.loc2)])]
+            moved += pos[0] != pos[1]
+            print("\t".join([base.name, str(base.L), str(test.L), str(diff)] +
+                            pos + [str(int(pos[0] != pos[1]))]), file=fout)
+    print("[EpiAlignment]Precision " + param['precision'] + " against " +
+          "float64 on " + str(len(sample)) + " region pairs: maximal score " +
+          "difference " + str(max_diff) + " (averaged score " +
+          str(max_ave_diff) + "), positions changed in " + str(moved) +
+          " pairs.", file=sys.stderr)
+
+
+def Generate_pairs(count, n_epi, seed=0):
+    '''
+    Generate region pairs for Conformance: a random target region and a
+        query region copied from part of it with substitutions, insertions
+        and deletions, with random epi-states. The lengths range from a
+        single base to a few hundred, and either region may be the longer.
+    return: a list of HomoRegion objects.
+    '''
+    rng = random.Random(seed)
+    typecode = Epi_typecode(n_epi)
+    pairs = []
+    for k in range(count):
+        n = rng.choice([1, 2, rng.randint(3, 50), rng.randint(50, 400)])
+        target = [rng.randrange(4) for j in range(n)]
+        start = rng.randrange(n)
+        query = []
+        for b in target[start:start + rng.randint(1, n)]:
+            r = rng.random()
+            if r < 0.1:
+                query.append(rng.randrange(4))
+            elif r < 0.15:
+                query += [b, rng.randrange(4)]
+            elif r >= 0.2:
+                query.append(b)
+        if not query:
+            query = [rng.randrange(4)]
+        S = HomoRegion()
+        S.name = "generated_" + str(k)
+        S.n_epi = n_epi
+        S.S1, S.S2 = array("B", query), array("B", target)
+        if rng.random() < 0.3:
+            S.S1, S.S2 = S.S2, S.S1
+        S.S1_epi = array(typecode, [rng.randrange(1 << n_epi)
+                                    for i in range(len(S.S1))])
+        S.S2_epi = array(typecode, [rng.randrange(1 << n_epi)
+                                    for j in range(len(S.S2))])
+        pairs.append(S)
+    return pairs
+
+
+def Conformance(S, p_num, param, n_generated, tolerance, out_name,
+                pool=None):
+    '''
+    Check param['kernel'] against the python kernel with float64 scores, on
+        the region pairs of S and on n_generated pairs made by
+        Generate_pairs.
+    out_name: the file to which the results of each pair are written.
+    If a score (L or averagedL) differs by more than tolerance, or the
+        kernel ends the alignment in a cell whose score in the python
+        kernel is more than tolerance below the best one, an exception is
+        raised after all pairs are compared. Other position differences
+        come from ties broken differently by rounding: with float64 scores,
+        the numpy and batch kernels give the same positions as the python
+        kernel.
+    '''
+    sample = S + Generate_pairs(n_generated, S[0].n_epi)
+    # The scores of the last row and column show whether an end cell ties.
+    base_param = dict(param, kernel="python", precision="float64",
+                      all_prob=True)
+    S_base = [copy.copy(pair) for pair in sample]
+    S_test = [copy.copy(pair) for pair in sample]
+    Manhattan_obj([S_base], p_num, [base_param], pool)
+    Manhattan_obj([S_test], p_num, [param], pool)
+
+    max_diff = 0.0
+    failed = 0
+    with open(out_name, "w") as fout:
+        print("\t".join(["name", "L_python", "L_" + param['kernel'], "diff",
+                         "pos_python", "pos_" + param['kernel'], "pass"]),
+              file=fout)
+        for base, test in zip(S_base, S_test):
+            diff = max(abs(test.L - base.L),
+                       abs(test.averagedL - base.averagedL))
+            if math.isnan(diff):
+                diff = float('Inf')
+            max_diff = max(max_diff, diff)
+            pos = [",".join([str(pair.start_point[0]), str(pair.loc1),
+                             str(pair.start_point[1]), str(pair.loc2)])
+                   for pair in (base, test)]
+            ok = diff <= tolerance
+            if pos[0] != pos[1]:
+                m = min(len(base.S1), len(base.S2))
+                if test.loc1 == m:
+                    end = base.prob[test.loc2 - 1]
+                else:
+                    end = base.prob[len(base.prob) - m + test.loc1 - 1]
+                ok = ok and base.L - end <= tolerance
+            failed += not ok
+            print("\t".join([base.name, str(base.L), str(test.L), str(diff)] +
+                            pos + [str(int(ok))]), file=fout)
+    print("[EpiAlignment]Kernel " + param['kernel'] + " against python on " +
+          str(len(sample)) + " region pairs (" + str(n_generated) +
+          " generated): maximal score difference " + str(max_diff) + ", " +
+          str(failed) + " pairs beyond the tolerance.", file=sys.stderr)
+    if failed:
+        raise Exception(306, "The kernel " + param['kernel'] + " differs " +
+                        "from the python kernel in " + str(failed) +
+                        " region pairs.")
+
+
+def Run(args, pool=None):
+    '''
+    Align the region pairs of a run.
+    pool: the pool of a service (see Serve), or None to start
+        args.process_num processes.
+    '''
+    S, maxlen1, maxlen2, ave1, ave2 = ReadInput(args.Input)
+
+    param = dict()
+
+    p_num = args.process_num
+
+    param['kernel'] = args.kernel
+    param['precision'] = args.precision
+    param['batch_size'] = max(1, args.batch_size)
+    param['window'] = max(1, args.window)
+    param['band'] = args.band
+    Kernel_backend(args.kernel)
+    if args.kernel in ("numpy", "batch") and np is None:
+        raise Exception(303, "The " + args.kernel + " kernel requires numpy.")
+    if args.precision != "float64" and args.kernel == "python" and \
+            args.check_precision is None and not args.sweep:
+        raise Exception(303, "--precision applies to the numpy and batch " +
+                        "kernels only.")
+    if args.conformance is not None:
+        if args.conformance < 0:
+            raise Exception(303, "Invalid number of generated pairs.")
+        if args.band is not None or args.prefilter is not None:
+            raise Exception(303, "--conformance cannot be combined with " +
+                            "--band or --prefilter.")
+    if args.check_precision is not None:
+        if np is None:
+            raise Exception(303, "--check_precision requires numpy.")
+        if args.check_precision < 1:
+            raise Exception(303, "Invalid --check_precision sample size.")
+    if args.band is not None:
+        if args.band < 0:
+            raise Exception(303, "The band width cannot be negative.")
+        if np is None:
+            raise Exception(303, "Banded alignment requires numpy.")
+        if args.kernel == "batch":
+            raise Exception(303, "Banded alignment cannot be combined " +
+                            "with the batch kernel.")
+    param['path_cells'] = max(1, args.path_cells)
+    param['prefilter'] = args.prefilter is not None
+    param['seed_k'] = args.seed_k
+    param['seed_margin'] = args.seed_margin
+    param['seed_windows'] = args.seed_windows
+    param['seed_max_occ'] = args.seed_max_occ
+    param['hit_summary'] = args.hit_summary
+    if param['prefilter']:
+        if np is None:
+            raise Exception(303, "--prefilter requires numpy.")
+        if args.kernel == "batch":
+            raise Exception(303, "--prefilter cannot be combined with the " +
+                            "batch kernel.")
+        if args.seed_k < 1 or args.seed_margin < 0 or \
+                args.seed_windows < 1 or args.seed_max_occ < 1:
+            raise Exception(303, "Invalid --prefilter settings.")
+
+    n_sets = len(args.equil_file or [])
+    if n_sets == 0 or len(args.output or []) != n_sets:
+        raise Exception(303, "One output file (-o) is needed per parameter " +
+                        "file (-e).")
+    for opt, files in [("-O", args.out_allvec), ("-r", args.align_path)]:
+        if files is not None and len(files) != n_sets:
+            raise Exception(303, "One " + opt + " file is needed per " +
+                            "parameter file (-e).")
+
+    # Parameters, score vector file and path file of each parameter set.
+    if args.sweep:
+        if n_sets != 1:
+            raise Exception(303, "--sweep needs one parameter file (-e).")
+        if args.out_allvec or args.align_path or args.hit_summary:
+            raise Exception(303, "--sweep cannot be combined with -O, -r " +
+                            "or --hit_summary.")
+        if np is None:
+            raise Exception(303, "--sweep requires numpy.")
+        if args.kernel == "batch":
+            raise Exception(303, "--sweep cannot be combined with the " +
+                            "batch kernel.")
+        param['kernel'] = "numpy"
+        axes = ReadSweep(args.sweep, S[0].n_epi)
+        points = list(itertools.product(*[a[2] for a in axes]))
+        x, weights, equil_dict, log_equil_dict = ReadParameters(
+            args.equil_file[0])
+        sets = []
+        for point in points:
+            point_x = list(x)
+            for (name, indices, values), value in zip(axes, point):
+                for i in indices:
+                    point_x[i] = value
+            sets.append(((point_x, weights, equil_dict, log_equil_dict),
+                         None, None))
+    else:
+        sets = [(ReadParameters(f_name),
+                 args.out_allvec[k] if args.out_allvec else None,
+                 args.align_path[k] if args.align_path else None)
+                for k, f_name in enumerate(args.equil_file)]
+
+    # One parameter dictionary per parameter set, and one list of region
+    # pairs for the results of each.
+    params = []
+    S_sets = [S] + [[copy.copy(pair) for pair in S]
+                    for k in range(1, len(sets))]
+    for model, all_prob, align_path in sets:
+        set_param = dict(param)
+        set_param['all_prob'] = all_prob
+        set_param['align_path'] = align_path
+        Model_param(set_param, model, S[0].n_epi, ave1, ave2)
+        params.append(set_param)
+
+    if args.conformance is not None:
+        Conformance(S, p_num, params[0], args.conformance, args.tolerance,
+                    args.output[0], pool)
+        return
+
+    if args.check_precision is not None:
+        Check_precision(S, p_num, params[0], args.check_precision,
+                        args.output[0], pool)
+        return
+
+    if args.sweep:
+        writer = ResultWriter(S_sets, params, args.output, axes, points)
+    else:
+        writer = ResultWriter(S_sets, params, args.output,
+                              vec_format=args.vec_format)
+    n_done = 0
+    checkpoint = args.checkpoint
+    if args.resume and checkpoint is None:
+        checkpoint = ""
+    if checkpoint is not None:
+        checkpoint = checkpoint or args.output[0] + ".checkpoint"
+        writer.interval = args.checkpoint_interval
+        n_done = Open_checkpoint(checkpoint, Run_digest(args), S_sets,
+                                 writer, args.resume)
+        if n_done > 0:
+            print("[EpiAlignment]Resumed " + str(n_done) + " of " +
+                  str(len(S)) + " region pairs from " + checkpoint + ".",
+                  file=sys.stderr)
+    cache = None
+    if args.cache:
+        cache = PairCache(args.cache, args.cache_size * (1 << 20))
     # t0 = time()
-    Manhattan_obj(S, p_num, param)
+    try:
+        stats = Manhattan_obj([S_set[n_done:] for S_set in S_sets], p_num,
+                              params, pool,
+                              lambda i: writer.write(n_done + i), cache)
+    finally:
+        writer.close()
+    if cache is not None:
+        cache.evict()
+        print("[EpiAlignment]Cache: " + str(cache.hits) + " hits, " +
+              str(cache.misses) + " misses, " + str(cache.evicted) +
+              " entries evicted.", file=sys.stderr)
+    if checkpoint is not None:
+        # The checkpoint may already have been removed by another run.
+        try:
+            os.unlink(checkpoint)
+        except FileNotFoundError:
+            pass
     # t1 = time()
-    if param['all_prob']:
-        with open(args.output, "w") as fout, \
-                open(args.out_allvec, "w") as fout2:
-            for pair in S:
-                print("\t".join(
-                    [
-                        pair.name,
-                        str(pair.L),
-                        str(pair.averagedL),
-                        str(pair.start_point[0]),
-                        str(pair.loc1),
-                        str(pair.start_point[1]),
-                        str(pair.loc2)
-                    ]), file=fout)
-                print(",".join([str(f)
-                                for f in [pair.name] + pair.prob]), file=fout2)
-    else:
-        with open(args.output, "w") as fout:
-            for pair in S:
-                print("\t".join(
-                    [
-                        pair.name,
-                        str(pair.L),
-                        str(pair.averagedL),
-                        str(pair.start_point[0]),
-                        str(pair.loc1),
-                        str(pair.start_point[1]),
-                        str(pair.loc2)
-                    ]), file=fout)
+
+    if param['band'] is not None:
+        for k, S_set in enumerate(S_sets):
+            n_edge = sum(1 for pair in S_set if pair.band_edge)
+            if n_edge > 0:
+                print("[EpiAlignment]The best alignment touched the band " +
+                      "edge in " + str(n_edge) + " region pairs" +
+                      (" (parameter set " + str(k) + ")"
+                       if len(S_sets) > 1 else "") +
+                      ". Consider a wider band.", file=sys.stderr)
+
+    if params[0]['prefilter']:
+        Prefilter_stats(S, args.prefilter)
+
+    if args.worker_stats is not None:
+        Worker_stats(stats, args.worker_stats)
+
+    if args.pair_stats is not None:
+        Pair_stats(S[n_done:], stats,
+                   args.pair_stats or args.output[0] + ".pairs.jsonl", n_done)
 
     # print >>sys.stderr, "Time:%f" % ((t1 - t0) / 60)
 
 
+def Serve_request(request, pool, p_num):
+    '''
+    Do a run sent by Forward, in the directory of the client.
+    request: a dictionary with the command line (argv) and the working
+        directory (cwd) of the client.
+    pool, p_num: the pool of the service and its number of processes.
+    return: a dictionary with the exit code and the messages written to
+        stderr by the run.
+    '''
+    err = io.StringIO()
+    code = 0
+    cwd = os.getcwd()
+    try:
+        os.chdir(request['cwd'])
+        with redirect_stderr(err):
+            args = ParseArg(request['argv'])
+            args.process_num = p_num
+            Run(args, pool)
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except Exception as e:
+        if len(e.args) == 2 and isinstance(e.args[0], int):
+            code = e.args[0]
+            print(e.args[1], file=err)
+        else:
+            code = 1
+            print(repr(e), file=err)
+    finally:
+        os.chdir(cwd)
+    return {'code': code, 'stderr': err.getvalue()}
+
+
+def Serve(args):
+    '''
+    Run the aligner as a service on the Unix socket args.serve. The worker
+        processes are started once, and the runs sent by Forward are done
+        one at a time, each using all the workers.
+    '''
+    # Remove the socket on SIGTERM as well.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if os.path.exists(args.serve):
+        os.unlink(args.serve)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(args.serve)
+    server.listen(16)
+    with get_context("spawn").Pool(
+            args.process_num, initializer=Init_worker,
+            initargs=(None,)) as pool:
+        print("[EpiAlignment]Listening on " + args.serve + " with " +
+              str(args.process_num) + " processes.", file=sys.stderr)
+        try:
+            while True:
+                conn, _ = server.accept()
+                with conn, conn.makefile("rwb") as fconn:
+                    request = json.loads(fconn.readline().decode())
+                    reply = Serve_request(request, pool, args.process_num)
+                    fconn.write((json.dumps(reply) + "\n").encode())
+        finally:
+            server.close()
+            os.unlink(args.serve)
+
+
+def Forward(address):
+    '''
+    Send the command line to the service listening on address (see Serve),
+        and exit with the exit code of the run.
+    return: False if the service cannot be reached, or if it closed the
+        connection without a reply, e.g. because it was stopped during the
+        run. The run is then done locally from the start.
+    '''
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(address)
+    except OSError:
+        conn.close()
+        return False
+    request = {'argv': sys.argv[1:], 'cwd': os.getcwd()}
+    with conn, conn.makefile("rwb") as fconn:
+        try:
+            fconn.write((json.dumps(request) + "\n").encode())
+            fconn.flush()
+            line = fconn.readline()
+        except OSError:
+            line = b""
+    if not line:
+        print("[EpiAlignment]The service at " + address + " closed the " +
+              "connection without a reply. Running locally.",
+              file=sys.stderr)
+        return False
+    reply = json.loads(line.decode())
+    sys.stderr.write(reply['stderr'])
+    sys.exit(reply['code'])
+
+
+def Main():
+    args = ParseArg()
+    if args.serve:
+        Serve(args)
+    elif args.server is None or not Forward(args.server):
+        Run(args)
+
+
 if __name__ == "__main__":
     Main()
@@ -20,6 +20,7 @@ def ParseArg():
   p.add_argument("--s_path",type=str, default="samtools", help="path of samtools")
   p.add_argument("-p","--p_num",type=int, default=5, help="Number of processes.")
   p.add_argument("-o","--output",type=str,help="output file name.")
+  p.add_argument("--diag",type=int,help="Expected offset of the query region in the target region. If specified, diag=<offset> is added to the headers for banded alignment.")
   if len(sys.argv)==1:
     print >>sys.stderr, p.print_help()
     sys.exit(0)
@@ -132,6 +133,8 @@ def Generate_output_str(bed_pair):
 
     i += 1
   one_name = "$$$" + "$".join([str(f) for f in one_numbers])
+  if args.diag is not None:
+    one_name += " diag=" + str(args.diag)
   output_list[0] += one_name
   output_list[4] += one_name
 
@@ -13,6 +13,7 @@ from rpy2.robjects import DataFrame
 from rpy2.robjects.packages import importr
 import numpy as np
 from math import *
+from ScoreVectors import ScoreVectors, MAGIC
 rpy2.robjects.numpy2ri.activate()
 gridExtra = importr("gridExtra")
 
@@ -37,16 +38,28 @@ def Extract_name(fname, ind):
 def Extract_selected_region(fname, ind, tlen):
   '''
   tlen: length of the target region.
+  The score file is a binary store (see ScoreVectors.py), or the text
+    format of -O, one comma-separated line per region pair.
   '''
-  i = 1
-  with open(fname, "r") as fin:
-    for line in fin:
-      if i == ind:
-        line = line.strip().split(",")[1:]
-        query_len = len(line) - tlen
-        norm_factor = 1000.0 / query_len
-        return [float(f) * norm_factor for f in line]
-      i += 1
+  with open(fname, "rb") as fin:
+    binary = fin.read(len(MAGIC)) == MAGIC
+  if binary:
+    scores = ScoreVectors(fname)
+    if 1 <= ind <= len(scores):
+      line = scores[ind - 1]
+      query_len = len(line) - tlen
+      norm_factor = 1000.0 / query_len
+      return (line.astype(float) * norm_factor).tolist()
+  else:
+    i = 1
+    with open(fname, "r") as fin:
+      for line in fin:
+        if i == ind:
+          line = line.strip().split(",")[1:]
+          query_len = len(line) - tlen
+          norm_factor = 1000.0 / query_len
+          return [float(f) * norm_factor for f in line]
+        i += 1
 
   print >> sys.stderr, "No such image index."
   sys.exit(310)
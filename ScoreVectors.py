@@ -0,0 +1,105 @@
+'''
+Binary store of the score vectors written by EpiAlignment_3.py -O with
+--vec_format binary.
+
+Layout (little-endian):
+  "EPIVEC01"
+  the vectors of the region pairs, in the input order, as float32 values;
+  the offset table: n + 1 uint64 byte offsets of the vectors in the file;
+  the names of the region pairs, utf-8, separated by newlines;
+  a footer: uint64 n, uint64 position of the offset table, "EPIVEC01".
+
+The offset table is written when the file is closed, so that vectors can be
+streamed to disk as the alignments finish. A file without its footer is
+incomplete.
+
+Usage: python ScoreVectors.py scores > scores.txt
+  converts a binary store to the text format of -O: one line per region
+  pair, with the name and the scores separated by commas.
+'''
+from __future__ import print_function
+import struct
+import sys
+from array import array
+
+MAGIC = b"EPIVEC01"
+FOOTER = struct.Struct("<QQ8s")
+
+
+class VectorWriter(object):
+    '''
+    Write score vectors to a binary store, one region pair at a time.
+    '''
+
+    def __init__(self, fname):
+        self.fout = open(fname, "wb")
+        self.fout.write(MAGIC)
+        self.offsets = array("Q", [len(MAGIC)])
+        self.names = []
+
+    def write(self, name, scores):
+        values = array("f", scores)
+        if sys.byteorder == "big":
+            values.byteswap()
+        self.fout.write(values.tobytes())
+        self.offsets.append(self.offsets[-1] + 4 * len(values))
+        self.names.append(name)
+
+    def flush(self):
+        self.fout.flush()
+
+    def close(self):
+        # The offset table starts at a multiple of 8 bytes.
+        pad = -self.offsets[-1] % 8
+        self.fout.write(b"\0" * pad)
+        index_pos = self.offsets[-1] + pad
+        offsets = array("Q", self.offsets)
+        if sys.byteorder == "big":
+            offsets.byteswap()
+        self.fout.write(offsets.tobytes())
+        self.fout.write("\n".join(self.names).encode("utf-8"))
+        self.fout.write(FOOTER.pack(len(self.names), index_pos, MAGIC))
+        self.fout.close()
+
+
+class ScoreVectors(object):
+    '''
+    Read a binary store through a memory map. store[i] is the score vector of
+        the i-th region pair (0-based), as a read-only float32 numpy array that
+        is only read from disk when it is used. store.names holds the names of
+        the region pairs.
+    '''
+
+    def __init__(self, fname):
+        import numpy as np
+        self.data = np.memmap(fname, dtype=np.uint8, mode="r")
+        if len(self.data) < len(MAGIC) + FOOTER.size:
+            raise ValueError(fname + " is not a score vector file.")
+        n, index_pos, magic = FOOTER.unpack(
+            self.data[-FOOTER.size:].tobytes())
+        if magic != MAGIC or self.data[:len(MAGIC)].tobytes() != MAGIC:
+            raise ValueError(fname + " is not a complete score vector file.")
+        names_pos = index_pos + 8 * (n + 1)
+        self.offsets = self.data[index_pos:names_pos].view("<u8")
+        names = self.data[names_pos:-FOOTER.size].tobytes().decode("utf-8")
+        self.names = names.split("\n") if n > 0 else []
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].view("<f4")
+
+
+def Main():
+    if len(sys.argv) != 2:
+        print(__doc__, file=sys.stderr)
+        sys.exit(1)
+    store = ScoreVectors(sys.argv[1])
+    for i in range(len(store)):
+        print(",".join([store.names[i]] +
+                       [str(float(f)) for f in store[i]]))
+
+
+if __name__ == "__main__":
+    Main()
@@ -1,6 +1,6 @@
 import subprocess
 from subprocess import Popen, PIPE
-from numpy import percentile, mean
+from numpy import mean
 from scipy.stats import norm
 from itertools import izip
 from xplib.Annotation import Bed
@@ -14,6 +14,14 @@ import re
 
 ensembl_regexp = 'ENS[A-Z]+[0-9]{11}'
 WARNING_SIZE = 10000
+# Unix socket of a running aligner service (EpiAlignment_3.py --serve), if any.
+ALIGNER_SOCKET = os.environ.get("EPIALIGNMENT_SOCKET", "")
+
+# Kernel backend of EpiAlignment_3.py (-k). The numpy kernel aligns the
+# epigenome and the sequence-only parameter sets in one traversal of each
+# matrix, with the same results as the python kernel. It needs numpy in
+# python3; set EPIALIGNMENT_KERNEL=python on hosts without it.
+ALIGNER_KERNEL = os.environ.get("EPIALIGNMENT_KERNEL", "numpy")
 
 def ParseJson():
   '''
@@ -676,12 +684,18 @@ def ExeEpiAlignment(alignMode, searchRegionMode, bed1, bed2, genAssem, of_name,
   cmd_list = ["python3", "EpiAlignment_3.py", of_name + "Input_" + runid] +\
     ["-e", of_name + "parameters_" + runid] +\
     ["-p", "140"] +\
-    ["-o", of_name + "epialign_res_" + runid]
+    ["-o", of_name + "epialign_res_" + runid] +\
+    ["-k", ALIGNER_KERNEL]
 
-  cmd_list_seq = ["python3", "EpiAlignment_3.py", of_name + "Input_" + runid] +\
-    ["-e", of_name + "parameters_seq_" + runid] +\
-    ["-p", "140"] +\
-    ["-o", of_name + "seqalign_res_" + runid]
+  # The sequence-only alignment is done in the same run, with a second
+  # parameter file and output file.
+  if seq_stat:
+    cmd_list += ["-e", of_name + "parameters_seq_" + runid] +\
+      ["-o", of_name + "seqalign_res_" + runid]
+
+  # Use the warm worker pool of the aligner service if there is one.
+  if ALIGNER_SOCKET:
+    cmd_list += ["--server", ALIGNER_SOCKET]
 
   # Fetch gene Ids.
   cmd_list_gene1 = ["python", "EnhancerOverlappingGenes.py", bed1] + \
@@ -698,28 +712,21 @@ def ExeEpiAlignment(alignMode, searchRegionMode, bed1, bed2, genAssem, of_name,
 
   if alignMode == "promoter":
     p_epi = Popen(cmd_list, stderr=PIPE)
-    if seq_stat:
-      p_seq = Popen(cmd_list_seq, stderr=PIPE)
     (std_out_epi, std_err_epi) = p_epi.communicate()
     exit_code_epi = p_epi.returncode
     if exit_code_epi != 0:
       print >> sys.stderr, "[EpiAlignment]Failed to align regions. Exit code: " + str(exit_code_epi)
       sys.exit(exit_code_epi)
 
-    if seq_stat:
-      (std_out_seq, std_err_seq) = p_seq.communicate()
-      exit_code_seq = p_seq.returncode
-      if exit_code_seq != 0:
-        print >> sys.stderr, "[EpiAlignment]Failed to align regions. Exit code: " + str(exit_code_seq)
-        sys.exit(exit_code_seq)
-
   elif alignMode == "enhancer":
     cmd_list += ["-O", of_name + "epi_scores_" + runid]
-    cmd_list_seq += ["-O", of_name + "seq_scores_" + runid]
+    if seq_stat:
+      cmd_list += ["-O", of_name + "seq_scores_" + runid]
+    # The score vectors are only kept for the plots (Plot_selected_region.py).
+    # The values needed by SequenceEvaluation are summarized by the aligner.
+    cmd_list += ["--vec_format", "binary", "--hit_summary"]
 
     p_epi = Popen(cmd_list, stderr=PIPE)
-    if seq_stat:
-      p_seq = Popen(cmd_list_seq, stderr=PIPE)
     # Fetch overlapping genes.
     p_gene1 = Popen(cmd_list_gene1, stderr=PIPE)
     p_gene2 = Popen(cmd_list_gene2, stderr=PIPE)
@@ -738,13 +745,6 @@ def ExeEpiAlignment(alignMode, searchRegionMode, bed1, bed2, genAssem, of_name,
       print >> sys.stderr, "[EpiAlignment]Failed to align regions. Exit code: " + str(exit_code_epi)
       sys.exit(exit_code_epi)
 
-    if seq_stat:
-      (std_out_seq, std_err_seq) = p_seq.communicate()
-      exit_code_seq = p_seq.returncode
-      if exit_code_seq != 0:
-        print >> sys.stderr, "[EpiAlignment]Failed to align regions. Exit code: " + str(exit_code_seq)
-        sys.exit(exit_code_seq)
-
 ###################
 ## Parse results ##
 ###################
@@ -813,27 +813,18 @@ def RegionName(json_obj, pair_name, intype1, intype2, alignMode):
       json_obj["ensID2"] = pair_name[1].split("_")[0]
       json_obj["transID2"] = pair_name[1].split("_")[1]
 
-def ExtractScore(scores, pos, ext_dis):
-  start = max(0, pos - ext_dis)
-  stop = pos + ext_dis
-  return max(scores[start:stop])
-
-def Signal_to_Noise(scores, bin, query_len):
+def Signal_to_Noise(line):
   '''
-  Fragmentize the score list into bins with length bin. 
-  Compute max and min in each bin. 
-  Return medians of maximum and minimum. 
+  The upper and lower signal-to-noise bounds of an alignment: the 75th
+  percentile of the maxima and the 25th percentile of the minima of the
+  scores in 500 bp bins, summarized by the aligner (--hit_summary) in the
+  last two fields of its result line.
+  return: (upper, lower), or (None, None) if the aligner wrote "." because
+  the target had no scores to estimate the noise from.
   '''
-  i = query_len
-  max_values = []
-  min_values = []
-  while i + bin < len(scores):
-    max_values.append(max(scores[i:i + bin]))
-    min_values.append(min(scores[i:i + bin]))
-    i = i + bin
-  max_values.append(max(scores[i:]))
-  min_values.append(min(scores[i:]))
-  return percentile(max_values, 75), percentile(min_values, 25)
+  if line[-2] == "." or line[-1] == ".":
+    return None, None
+  return float(line[-2]), float(line[-1])
 
 
 def snCalculater(signal, mid_point, half_noise):
@@ -871,7 +862,7 @@ def FitNorm(signal, mean_value, sd_value):
   return "."
 
 
-def SequenceEvaluation(json_obj, line_epi, line_seq, epiScore, seqScore, s, mu, seq_bg):
+def SequenceEvaluation(json_obj, line_epi, line_seq, s, mu, seq_bg):
   '''
   In json object, "shifted" has three possible values: Y, N, .
   The last value means that only sequence-only alignment was performed.
@@ -883,10 +874,10 @@ def SequenceEvaluation(json_obj, line_epi, line_seq, epiScore, seqScore, s, mu,
   s1 = json_obj["scoreS"]
   s2 = None
   if json_obj["shifted"] == "Y":
-    # extract epi-score for the seq-hit
-    e2 = ExtractScore(epiScore, int(line_seq[6]), 50) * norm_factor
-    # extract seq-score for the epi-hit
-    s2 = ExtractScore(seqScore, int(line_epi[6]), 50) * norm_factor
+    # epi-score around the seq-hit (+-50 bp), summarized by the aligner
+    e2 = float(line_epi[7]) * norm_factor
+    # seq-score around the epi-hit
+    s2 = float(line_seq[7]) * norm_factor
     seqEval_dict["scoreE2"] = e2
     seqEval_dict["scoreS2"] = s2
   elif json_obj["shifted"] == "N":
@@ -901,16 +892,21 @@ def SequenceEvaluation(json_obj, line_epi, line_seq, epiScore, seqScore, s, mu,
   #seqEval_dict["bgPvalueE"] = FitNorm(s2, seq_bg["backgroundMean"], seq_bg["backgroundSd"])
   # SignalToNoise ratio
   if json_obj["shifted"] != ".":
-    upper, lower = Signal_to_Noise(seqScore, 500, query_len)
+    upper, lower = Signal_to_Noise(line_seq)
   else:
-    upper, lower = Signal_to_Noise(epiScore, 500, query_len)
-  upper = upper * norm_factor
-  lower = lower * norm_factor
-  seqEval_dict["signalToNoise"] = {"upperBound": upper, "lowerBound": lower} 
-  half_noise = (upper - lower) / 2
-  mid_point = (upper + lower) / 2
-  seqEval_dict["signalToNoise"]["snS"] = snCalculater(s1, mid_point, half_noise)
-  seqEval_dict["signalToNoise"]["snE"] = snCalculater(s2, mid_point, half_noise)
+    upper, lower = Signal_to_Noise(line_epi)
+  if upper is None:
+    # No noise estimate: no ratio either.
+    seqEval_dict["signalToNoise"] = {"upperBound": ".", "lowerBound": ".",
+      "snS": ".", "snE": "."}
+  else:
+    upper = upper * norm_factor
+    lower = lower * norm_factor
+    seqEval_dict["signalToNoise"] = {"upperBound": upper, "lowerBound": lower} 
+    half_noise = (upper - lower) / 2
+    mid_point = (upper + lower) / 2
+    seqEval_dict["signalToNoise"]["snS"] = snCalculater(s1, mid_point, half_noise)
+    seqEval_dict["signalToNoise"]["snE"] = snCalculater(s2, mid_point, half_noise)
   if json_obj["scoreE"] - seqEval_dict["scoreE2"] < 10.0:
     json_obj["shifted"] = "N"
   
@@ -963,23 +959,16 @@ def ParseAlignResults(bed1, bed2, intype1, intype2, alignMode, searchRegionMode,
 
   epi_fname = of_name + "epialign_res_" + runid
   seq_fname = of_name + "seqalign_res_" + runid
-  epiScore_fname = of_name + "epi_scores_" + runid
-  seqScore_fname = of_name + "seq_scores_" + runid
   out_name = of_name + "AlignResults_" + runid + ".txt"
   seq_stat = os.path.isfile(seq_fname)
   seq_bg = SeqBg(s, mu, alignMode)
 
   if seq_stat:
     fseq = open(seq_fname, "r")
-  if alignMode == "enhancer":
-    fepiScore = open(epiScore_fname, "r")
-    if seq_stat:
-      fseqScore = open(seqScore_fname, "r")
 
   with open(epi_fname, "r") as fepi, open(out_name, "w") as fout:
     i = 1
     line_seq = None
-    line_seqScore = None
     while True:
       # Alignment results
       line_epi = fepi.readline().strip().split()
@@ -998,16 +987,8 @@ def ParseAlignResults(bed1, bed2, intype1, intype2, alignMode, searchRegionMode,
         RegionName(json_obj, pair_name, intype1, intype2, alignMode)
         # The following steps are only for enhancer mode.
         if alignMode == "enhancer":
-          query_len = json_obj["queryLength"]
-          line_epiScore = [float(f) for f in fepiScore.readline().strip().split(",")[1:]]
-          target_len = len(line_epiScore) - query_len
-          line_epiScore = line_epiScore[0:target_len]
-          if seq_stat:
-            line_seqScore = [float(f) for f in fseqScore.readline().strip().split(",")[1:]]
-            line_seqScore = line_seqScore[0:target_len]
           # Extract the two additional scores. Evaluate sequence similarity.
-
-          SequenceEvaluation(json_obj, line_epi, line_seq, line_epiScore, line_seqScore, s, mu, seq_bg)
+          SequenceEvaluation(json_obj, line_epi, line_seq, s, mu, seq_bg)
 
         # Write results to file.
         WriteFinalResult(json_obj, fout, alignMode)
@@ -0,0 +1,850 @@
+'''
+Tests of EpiAlignment_3.py. Run with: python -m pytest test_EpiAlignment_3.py
+'''
+import copy
+import io
+import os
+import pickle
+import random
+import socket
+import tempfile
+import threading
+import unittest
+from array import array
+from contextlib import redirect_stderr
+from math import log
+
+import EpiAlignment_3 as ea
+from ScoreVectors import ScoreVectors
+
+
+def Synthetic_model(n_epi, epi_weight=0.1):
+    '''
+    Model parameters for n_epi marks, in the form returned by
+        ea.ReadParameters.
+    '''
+    x = [0.1, 0.2] + [0.3] * n_epi
+    weights = [1.0] + [epi_weight] * n_epi
+    equil_dict = {"A": 0.25, "C": 0.25, "G": 0.25, "T": 0.25}
+    for k in range(1, n_epi + 1):
+        equil_dict[k] = [0.8, 0.2]
+    log_equil_dict = {}
+    for key, value in equil_dict.items():
+        if isinstance(value, list):
+            log_equil_dict[key] = [log(f) for f in value]
+        else:
+            log_equil_dict[key] = log(value)
+    return x, weights, equil_dict, log_equil_dict
+
+
+def Make_pair(seq1, seq2, n_epi=1, diag=None, epi1=None, epi2=None):
+    '''
+    A region pair. epi1 and epi2 are lists of epi-states, 0 by default.
+    '''
+    S = ea.HomoRegion()
+    S.name = "pair"
+    S.n_epi = n_epi
+    S.S1 = array("B", [ea.BASES.index(c) for c in seq1])
+    S.S2 = array("B", [ea.BASES.index(c) for c in seq2])
+    S.S1_epi = array(ea.Epi_typecode(n_epi), epi1 or [0] * len(seq1))
+    S.S2_epi = array(ea.Epi_typecode(n_epi), epi2 or [0] * len(seq2))
+    S.diag = diag
+    return S
+
+
+def Directory_size(path):
+    return sum(os.path.getsize(os.path.join(d, f))
+               for d, dirs, files in os.walk(path) for f in files)
+
+
+def Make_param(S, model=None, **kwargs):
+    param = {'kernel': "numpy", 'precision': "float64", 'band': None,
+             'prefilter': False, 'all_prob': None, 'align_path': None,
+             'hit_summary': False, 'batch_size': 1, 'seed_k': 12,
+             'seed_margin': 100, 'seed_windows': 4, 'seed_max_occ': 16}
+    param.update(kwargs)
+    ea.Model_param(param, model or Synthetic_model(S.n_epi), S.n_epi,
+                   len(S.S1), len(S.S2))
+    return param
+
+
+class ReferenceTest(unittest.TestCase):
+
+    # Pairs whose optimal cells are near-ties, with the results of the
+    # original implementation: (epi weight, query, query epi, target,
+    # target epi, L, averagedL, start point, loc1, loc2).
+    PAIRS = [
+        (0.0, "CTTCCGGA", "11001000",
+         "GTTCCAGTGTGAGGTAGATACGTGCAACCGAACAATAAAAAGGAACTCGGGCCCTACTAGG"
+         "TAACACCCCGAAGCATCCA",
+         "00000001110010111111010110000111111111111010101000100001011011"
+         "101011001001000111",
+         1.7251777294927275, -2.87957117280229, (0, 45), 8, 50),
+        (0.0, "TCCGCGGA", "10111100",
+         "TTATCCCAGAGCAAATGATTGCTGGTTTGCCACCCACTTTAACAATGTCCGTGATCGAGAC"
+         "ATCAGCCGATATATATACT",
+         "01001000001001101110011101111010111011111010001011110001011110"
+         "001011010100110110",
+         3.9092960893731514, -2.892840906278926, (0, 3), 8, 10),
+        (0.1, "AGTGTTTC", "10100101",
+         "ACGGTAGATGTGCGATGCAGCAAGTTACCATTTCGACCCCGACCATACTTTCAGGCCACCA"
+         "CATACACGCCGGGACGATT",
+         "10100010110101001110101110101000111000111100101110011001010000"
+         "001010000111011000",
+         2.049591694982544, -3.74680518599812, (0, 44), 8, 52),
+    ]
+
+    def test_positions_of_the_python_kernel(self):
+        for weight, seq1, epi1, seq2, epi2, L, averagedL, start, loc1, \
+                loc2 in self.PAIRS:
+            S = Make_pair(seq1, seq2, epi1=[int(c) for c in epi1],
+                          epi2=[int(c) for c in epi2])
+            ea.Manhattan(S, Make_param(S, Synthetic_model(1, weight),
+                                       kernel="python"))
+            self.assertEqual((S.L, S.averagedL, tuple(S.start_point),
+                              S.loc1, S.loc2),
+                             (L, averagedL, start, loc1, loc2))
+
+
+def Random_pair(rng, m, n, n_epi):
+    seq1 = "".join(rng.choice(ea.BASES) for i in range(m))
+    seq2 = "".join(rng.choice(ea.BASES) for i in range(n))
+    return Make_pair(seq1, seq2, n_epi,
+                     epi1=[rng.randrange(1 << n_epi) for i in range(m)],
+                     epi2=[rng.randrange(1 << n_epi) for i in range(n)])
+
+
+def Full_matrix_scores(S, param):
+    '''
+    The python kernel with full matrices, tuple start points and Maximum,
+        as it was before the row buffers were reused.
+    '''
+    S1, E1, S2, E2 = ea.Oriented(S)
+    m, n = len(S1), len(S2)
+    sym1 = ea.Encode_symbols(S1, E1, S.n_epi)
+    score_table, _, sym2, equil2 = ea.Score_rows(
+        param, ea.Encode_symbols(S2, E2, S.n_epi))
+    Na = float('-Inf')
+    manh3 = [[0] * (n + 1)] + [[0] + [Na] * n for i in range(m)]
+    manh2 = [[0] * (n + 1)] + [[Na] * (n + 1) for i in range(m)]
+    st = [[(0, j) for j in range(n + 1)]] + \
+        [[(i, 0)] + [None] * n for i in range(1, m + 1)]
+    for i in range(1, m + 1):
+        for j in range(1, n + 1):
+            ent0 = param['log_lamb_mu'] + param['log_link_p'][0] + \
+                manh3[i - 1][j] - param['half_diag_norm']
+            ent2 = param['log_lamb_beta'] + manh2[i][j - 1] - \
+                param['half_diag_norm']
+            ent1 = score_table[sym1[i - 1]][sym2[j - 1]] + \
+                manh3[i - 1][j - 1] - equil2[j - 1] - param['diag_norm']
+            manh3[i][j], manh2[i][j], di, dj = ea.Maximum(ent0, ent1, ent2,
+                                                          j)
+            st[i][j] = st[i - 1 + di][dj]
+    last_col = [manh3[i][n] for i in range(m + 1)]
+    last_col_st = [Na] + [st[i][n] for i in range(1, m + 1)]
+    ea.Summarize_scores(S, manh3[m], st[m], last_col, last_col_st, param)
+    return S
+
+
+class PythonKernelTest(unittest.TestCase):
+
+    def test_rows_of_both_parities(self):
+        rng = random.Random(3)
+        for m in range(1, 9):
+            for n_epi in (1, 2):
+                S = Random_pair(rng, m, rng.randint(m, 40), n_epi)
+                param = Make_param(S, Synthetic_model(n_epi),
+                                   kernel="python", all_prob=True)
+                ea.Manhattan(S, param)
+                full = Full_matrix_scores(copy.copy(S), param)
+                self.assertEqual(Kernel_fields(S), Kernel_fields(full))
+                self.assertTrue(all(type(v) is int for v in S.start_point))
+
+
+# The fields of a result record that the kernels compute.
+KERNEL_FIELDS = ("L", "averagedL", "loc1", "loc2", "start_point", "prob")
+
+
+def Kernel_fields(S):
+    return tuple(getattr(S, f) for f in KERNEL_FIELDS)
+
+
+@unittest.skipIf(ea.np is None, "numpy is not installed")
+class KernelEquivalenceTest(unittest.TestCase):
+
+    def test_numpy_sets_same_as_python(self):
+        # Short queries against long targets, and the reverse, have many
+        # near-ties between the cells.
+        rng = random.Random(0)
+        for k in range(40):
+            n_epi = 1 + k % 2
+            m = rng.randint(3, 12)
+            n = rng.randint(20, 120)
+            if k % 4 == 3:
+                m, n = n, m
+            S = Random_pair(rng, m, n, n_epi)
+            params = [Make_param(S, Synthetic_model(n_epi, w),
+                                 all_prob=True) for w in (0.0, 0.1)]
+            records = ea.Manhattan_np_sets(S, params)
+            for param, record in zip(params, records):
+                param['kernel'] = "python"
+                ea.Manhattan(S, param)
+                self.assertEqual(
+                    tuple(record[ea.RESULT_FIELDS.index(f)]
+                          for f in KERNEL_FIELDS), Kernel_fields(S))
+
+
+@unittest.skipIf(ea.np is None, "numpy is not installed")
+class BatchKernelTest(unittest.TestCase):
+
+    def test_batch_same_as_python(self):
+        # Pairs of different lengths and orientations padded together.
+        rng = random.Random(2)
+        for n_epi in (1, 2):
+            S = []
+            for k in range(12):
+                m, n = rng.randint(1, 15), rng.randint(10, 60)
+                if k % 3 == 2:
+                    m, n = n, m
+                S.append(Random_pair(rng, m, n, n_epi))
+            param = Make_param(S[0], Synthetic_model(n_epi), all_prob=True)
+            batch = [copy.copy(pair) for pair in S]
+            ea.Manhattan_batch(batch, param)
+            for pair, result in zip(S, batch):
+                ea.Manhattan(pair, dict(param, kernel="python"))
+                self.assertEqual(Kernel_fields(result), Kernel_fields(pair))
+
+    def test_batches_of_similar_lengths(self):
+        S = [Make_pair("A" * m, "A" * n)
+             for m, n in [(9, 20), (2, 30), (30, 3), (8, 8), (2, 4)]]
+        self.assertEqual(ea.Batch_pairs(S, 2), [[4, 1], [2, 3], [0]])
+
+
+@unittest.skipIf(ea.np is None, "numpy is not installed")
+class PrecisionTest(unittest.TestCase):
+
+    def test_scores_within_the_rounding_bounds(self):
+        rng = random.Random(5)
+        for k in range(20):
+            m, n = rng.randint(3, 30), rng.randint(30, 150)
+            S = Random_pair(rng, m, n, 2)
+            base = ea.Manhattan_np_sets(S, [Make_param(S)])[0]
+            for precision, bound in [("float32", 1e-4 * abs(base[0])),
+                                     ("fixed",
+                                      (m + n) / ea.FIXED_SCALE)]:
+                record = ea.Manhattan_np_sets(
+                    S, [Make_param(S, precision=precision)])[0]
+                self.assertLessEqual(abs(record[0] - base[0]), bound)
+
+    def test_fixed_point_falls_back_to_float64(self):
+        S = Make_pair("ACGT", "ACGT")
+        params = [Make_param(S, precision="fixed")]
+        self.assertEqual(ea.Kernel_precision(params, 100, 1000), "fixed")
+        self.assertEqual(ea.Kernel_precision(params, 10 ** 5, 10 ** 6),
+                         "float64")
+
+    def test_fixed_point_conversion(self):
+        Na = float('-Inf')
+        a = ea.Kernel_array([Na, -1.5, 2.0 ** -11, 3.25], "fixed")
+        self.assertEqual(a.tolist(), [ea.FIXED_NA, -1536, 0, 3328])
+        self.assertEqual(ea.Kernel_scores(a, "fixed").tolist(),
+                         [Na, -1.5, 0.0, 3.25])
+
+
+class EpiFactorsTest(unittest.TestCase):
+
+    def Factorized_param(self, S, model, **kwargs):
+        dense_marks = ea.EPI_DENSE_MARKS
+        try:
+            ea.EPI_DENSE_MARKS = S.n_epi - 1
+            return Make_param(S, model, **kwargs)
+        finally:
+            ea.EPI_DENSE_MARKS = dense_marks
+
+    def test_factors_same_as_dense_table(self):
+        S = Make_pair("ACGT", "ACGT", n_epi=3)
+        model = Synthetic_model(3, 0.2)
+        dense = Make_param(S, model)
+        factors = self.Factorized_param(S, model)['epi_factors']
+        symbols = range(4 << 3)
+        target = factors.target_terms(symbols)
+        for sym1 in symbols:
+            for sym2, f in zip(symbols, factors.row(sym1, target)):
+                self.assertAlmostEqual(f, dense['score_table'][sym1][sym2],
+                                       places=12)
+        for sym2, f in zip(symbols, target[3]):
+            self.assertAlmostEqual(f, dense['equil_row'][sym2], places=12)
+
+    def test_alignments_same_as_dense(self):
+        rng = random.Random(6)
+        model = Synthetic_model(3, 0.2)
+        kernels = [(ea.Manhattan, "python")]
+        if ea.np is not None:
+            kernels.append((ea.Manhattan_np, "numpy"))
+        for k in range(10):
+            S = Random_pair(rng, rng.randint(3, 12), rng.randint(20, 60), 3)
+            for align, kernel in kernels:
+                dense = copy.copy(S)
+                align(dense, Make_param(S, model, kernel=kernel))
+                align(S, self.Factorized_param(S, model, kernel=kernel))
+                self.assertAlmostEqual(S.L, dense.L, places=9)
+                self.assertEqual((S.start_point, S.loc1, S.loc2),
+                                 (dense.start_point, dense.loc1, dense.loc2))
+
+    @unittest.skipIf(ea.np is None, "numpy is not installed")
+    def test_sixteen_marks(self):
+        rng = random.Random(7)
+        S = Random_pair(rng, 10, 50, 16)
+        param = Make_param(S, all_prob=True)
+        self.assertIsNone(param['score_table'])
+        self.assertEqual(len(param['epi_factors'].alpha), 1 << 16)
+        record = ea.Manhattan_np_sets(S, [param])[0]
+        ea.Manhattan(S, dict(param, kernel="python"))
+        self.assertEqual(tuple(record[ea.RESULT_FIELDS.index(f)]
+                               for f in KERNEL_FIELDS), Kernel_fields(S))
+
+
+@unittest.skipIf(ea.np is None, "numpy is not installed")
+class BandEdgeTest(unittest.TestCase):
+
+    def test_corner_band_is_aligned_in_full(self):
+        # The band only touches the corner cell (0, n).
+        S = Make_pair("ACGTACGT", "ACGTACGT", diag=8)
+        param = Make_param(S, band=0)
+        self.assertIsNone(ea.Band_of(S, 8, 8, param))
+        ea.Manhattan_np(S, param)
+        full = Make_pair("ACGTACGT", "ACGTACGT")
+        ea.Manhattan(full, Make_param(full, kernel="python"))
+        self.assertEqual((S.loc1, S.loc2), (full.loc1, full.loc2))
+        self.assertAlmostEqual(S.L, full.L)
+
+    def test_corner_band_of_swapped_pair(self):
+        # The band only touches the corner cell (m, 0).
+        S = Make_pair("ACGTACGTAC", "ACGTACGT", diag=8)
+        param = Make_param(S, band=0)
+        self.assertIsNone(ea.Band_of(S, 8, 10, param))
+        ea.Manhattan_np(S, param)
+        self.assertNotEqual(S.averagedL, float('-Inf'))
+
+    def test_band_next_to_corner(self):
+        # A band of one cell beyond the first row.
+        S = Make_pair("ACGTACGT", "ACGTACGT", diag=7)
+        param = Make_param(S, band=0)
+        self.assertEqual(ea.Band_of(S, 8, 8, param), (7, 0))
+        ea.Manhattan_np(S, param)
+        self.assertEqual((S.loc1, S.loc2), (1, 8))
+
+    def test_summary_without_finite_scores(self):
+        S = Make_pair("ACGT", "ACGT")
+        param = Make_param(S)
+        Na = float('-Inf')
+        ea.Summarize_scores(S, [Na] * 5, [0] * 5, [Na] * 5, [0] * 5, param)
+        self.assertEqual(S.averagedL, Na)
+
+
+@unittest.skipIf(ea.np is None, "numpy is not installed")
+class SeedTest(unittest.TestCase):
+
+    def test_repeated_kmers_are_skipped(self):
+        S1 = array("B", [0, 1] * 50)
+        S2 = array("B", [0, 1] * 500)
+        E1 = array("B", [0] * len(S1))
+        E2 = array("B", [0] * len(S2))
+        self.assertEqual(ea.Find_seeds(S1, E1, S2, E2, 12, 16), [])
+        self.assertEqual(len(ea.Find_seeds(S1, E1, S2, E2, 12, 1000)),
+                         45 * 495 + 44 * 494)
+
+    def test_unique_match(self):
+        S = Make_pair("ACGTTGCA", "GGACGTTGCAGG")
+        S.S1_epi[0] = 1
+        S.S2_epi[2] = 1
+        self.assertEqual(ea.Find_seeds(S.S1, S.S1_epi, S.S2, S.S2_epi, 8,
+                                       16), [2])
+        S.S2_epi[3:8] = array("B", [1] * 5)
+        self.assertEqual(ea.Find_seeds(S.S1, S.S1_epi, S.S2, S.S2_epi, 8,
+                                       16), [])
+
+
+class ScheduleTest(unittest.TestCase):
+
+    def test_jobs_without_groups_by_cost(self):
+        chunks = ea.Schedule_jobs([1, 5, 3, 2], 1)
+        self.assertEqual(sum(chunks, []), [1, 2, 3, 0])
+
+    def test_jobs_of_a_group_together(self):
+        chunks = ea.Schedule_jobs([1, 5, 3, 2, 4], 1,
+                                  ["a", "b", "a", "c", "a"])
+        self.assertEqual(sum(chunks, []), [4, 2, 0, 1, 3])
+
+
+class WorkerTest(unittest.TestCase):
+
+    def tearDown(self):
+        ea.worker_param = None
+        ea.worker_param_key = None
+
+    def test_parameters_loaded_once_per_run(self):
+        S = Make_pair("ACGTTGCA", "GGACGTTGCAGG")
+        params = [Make_param(S, kernel="python")]
+        with tempfile.TemporaryDirectory() as path:
+            key = os.path.join(path, "run.param")
+            with open(key, "wb") as fout:
+                pickle.dump(params, fout)
+            pid, busy, results = ea.manhattanChunk((key, 0.0, [(0, S)]))
+            self.assertEqual(ea.worker_param_key, key)
+            # The file is not read again for the next chunks of the run.
+            os.remove(key)
+            pid, busy, again = ea.manhattanChunk((key, 0.0, [(1, S)]))
+        self.assertEqual([k for k, res, wait, seconds in results + again],
+                         [0, 1])
+        self.assertEqual(results[0][1], again[0][1])
+        self.assertEqual(results[0][1], ea.Align_pair(S, params))
+
+    def test_result_record_without_sequences(self):
+        S = Make_pair("ACGTTGCA", "GGACGTTGCAGG")
+        ea.Manhattan(S, Make_param(S, kernel="python"))
+        record = ea.Result_record(S)
+        self.assertEqual(len(record), len(ea.RESULT_FIELDS))
+        copy_S = ea.HomoRegion()
+        ea.Apply_result(copy_S, record)
+        self.assertEqual(Kernel_fields(copy_S), Kernel_fields(S))
+        self.assertEqual(len(copy_S.S1), 0)
+
+
+class SyncPool:
+    '''
+    Runs the chunks of Collect_results in the calling process. Records the
+        pairs in the order they are aligned, and the most pairs aligned and
+        not emitted yet.
+    '''
+
+    def __init__(self, emitted=()):
+        self.emitted = emitted
+        self.aligned = []
+        self.held = 0
+
+    def apply_async(self, func, args, callback, error_callback):
+        self.aligned += [job for k, job in args[0][2]]
+        self.held = max(self.held, len(self.aligned) - len(self.emitted))
+        callback(func(*args))
+
+
+def Write_input(fname, S):
+    '''
+    Write region pairs in the input format of the aligner.
+    '''
+    with open(fname, "w") as fout:
+        for pair in S:
+            for name, seq, epi in [(pair.name, pair.S1, pair.S1_epi),
+                                   (pair.name + "_t", pair.S2, pair.S2_epi)]:
+                print("@" + name, file=fout)
+                print("".join(ea.BASES[b] for b in seq), file=fout)
+                for k in range(pair.n_epi):
+                    shift = pair.n_epi - 1 - k
+                    print("+", file=fout)
+                    print("".join(str(e >> shift & 1) for e in epi),
+                          file=fout)
+
+
+def Write_model(fname, model):
+    '''
+    Write the parameters of Synthetic_model as a parameter file (-e).
+    '''
+    x, weights, equil_dict, log_equil_dict = model
+    with open(fname, "w") as fout:
+        for value in x:
+            print(value, file=fout)
+        print("\t".join(b + ":" + str(equil_dict[b]) for b in ea.BASES),
+              file=fout)
+        for k in range(1, len(weights)):
+            print("\t".join(str(s) + ":" + str(f)
+                            for s, f in enumerate(equil_dict[k])), file=fout)
+        print("\t".join(str(w) for w in weights), file=fout)
+
+
+def Run_aligner(argv):
+    '''
+    Run the aligner in this process.
+    '''
+    ea.Run(ea.ParseArg(argv), SyncPool())
+    ea.worker_param = None
+    ea.worker_param_key = None
+
+
+def Read(fname):
+    with open(fname) as fin:
+        return fin.read()
+
+
+class RunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = self.dir.name
+        rng = random.Random(4)
+        S = [Random_pair(rng, rng.randint(5, 20), rng.randint(20, 60), 2)
+             for k in range(6)]
+        for k, pair in enumerate(S):
+            pair.name = "pair" + str(k)
+        self.input = self.File("input")
+        Write_input(self.input, S)
+        self.models = []
+        for w in (0.1, 0.0):
+            self.models.append(self.File("model" + str(w)))
+            Write_model(self.models[-1], Synthetic_model(2, w))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def File(self, name):
+        return os.path.join(self.path, name)
+
+    @unittest.skipIf(ea.np is None, "numpy is not installed")
+    def test_sets_same_as_separate_runs(self):
+        for kernel in ("python", "numpy", "batch"):
+            Run_aligner([self.input, "-k", kernel, "-b", "4",
+                         "-e", self.models[0], "-e", self.models[1],
+                         "-o", self.File("o1"), "-o", self.File("o2"),
+                         "-O", self.File("v1"), "-O", self.File("v2")])
+            for k, model in enumerate(self.models):
+                Run_aligner([self.input, "-k", kernel, "-b", "4",
+                             "-e", model, "-o", self.File("s"),
+                             "-O", self.File("sv")])
+                self.assertEqual(Read(self.File("o" + str(k + 1))),
+                                 Read(self.File("s")))
+                self.assertEqual(Read(self.File("v" + str(k + 1))),
+                                 Read(self.File("sv")))
+            self.assertEqual(len(Read(self.File("o1")).splitlines()), 6)
+            self.assertNotEqual(Read(self.File("v1")), Read(self.File("v2")))
+
+    @unittest.skipIf(ea.np is None, "numpy is not installed")
+    def test_sweep_same_as_separate_runs(self):
+        with open(self.File("grid"), "w") as fout:
+            print("mu\t0.1,0.25", file=fout)
+            print("k2\t0.3,0.6", file=fout)
+        Run_aligner([self.input, "-e", self.models[0], "--sweep",
+                     self.File("grid"), "-o", self.File("sweep")])
+        lines = Read(self.File("sweep")).splitlines()
+        self.assertEqual(lines[0].split("\t")[:4], ["name", "set", "mu", "k2"])
+        expected = [[] for k in range(6)]
+        points = [(0.1, 0.3), (0.1, 0.6), (0.25, 0.3), (0.25, 0.6)]
+        for k, (mu, k2) in enumerate(points):
+            x, weights, equil_dict, log_equil_dict = Synthetic_model(2, 0.1)
+            x[1] = mu
+            x[3] = k2
+            Write_model(self.File("point"),
+                        (x, weights, equil_dict, log_equil_dict))
+            Run_aligner([self.input, "-e", self.File("point"), "-o",
+                         self.File("s")])
+            for i, line in enumerate(Read(self.File("s")).splitlines()):
+                fields = line.split("\t")
+                expected[i].append("\t".join(
+                    fields[:1] + [str(k), str(mu), str(k2)] + fields[1:]))
+        self.assertEqual(lines[1:], sum(expected, []))
+
+    @unittest.skipIf(ea.np is None, "numpy is not installed")
+    def test_binary_vectors_same_as_text(self):
+        for vec_format in ("text", "binary"):
+            Run_aligner([self.input, "-e", self.models[0], "-o",
+                         self.File("o"), "-O", self.File(vec_format),
+                         "--vec_format", vec_format])
+        store = ScoreVectors(self.File("binary"))
+        lines = Read(self.File("text")).splitlines()
+        self.assertEqual(len(store), len(lines))
+        for k, line in enumerate(lines):
+            fields = line.split(",")
+            self.assertEqual(store.names[k], fields[0])
+            self.assertEqual(store[k].tolist(), ea.np.array(
+                [float(f) for f in fields[1:]], dtype="f4").tolist())
+
+    @unittest.skipIf(ea.np is None, "numpy is not installed")
+    def test_check_precision_report(self):
+        err = io.StringIO()
+        with redirect_stderr(err):
+            Run_aligner([self.input, "-e", self.models[0], "--precision",
+                         "fixed", "--check_precision", "3", "-o",
+                         self.File("report")])
+        lines = Read(self.File("report")).splitlines()
+        self.assertEqual(lines[0].split("\t")[1:3], ["L_float64", "L_fixed"])
+        self.assertEqual(len(lines), 4)
+        for line in lines[1:]:
+            self.assertLess(float(line.split("\t")[3]), 0.1)
+        self.assertIn("Precision fixed against float64 on 3", err.getvalue())
+
+
+@unittest.skipIf(ea.np is None, "numpy is not installed")
+class CollectResultsTest(unittest.TestCase):
+
+    def Run(self, window, emit, weights=(0.1,), cache=None):
+        rng = random.Random(1)
+        S = [Random_pair(rng, 4 + (k * 7) % 23, 30, 1) for k in range(40)]
+        params = [Make_param(S[0], Synthetic_model(1, w), window=window)
+                  for w in weights]
+        emitted = []
+        pool = SyncPool(emitted)
+        ea.Init_worker(params)
+        try:
+            ea.Collect_results(pool, [S] * len(params), params, None,
+                               {'p_num': 2, 'workers': {}, 'pairs': {}},
+                               emitted.append if emit else None, cache)
+        finally:
+            ea.Init_worker(None)
+        return S, emitted, pool
+
+    def test_pairs_by_cost_over_the_whole_input(self):
+        S, emitted, pool = self.Run(4, False)
+        self.assertEqual(len(pool.aligned), 40)
+        self.assertEqual(len(pool.aligned[0].S1), 26)
+
+    def test_reorder_buffer_is_bounded(self):
+        S, emitted, pool = self.Run(4, True)
+        self.assertEqual(emitted, list(range(40)))
+        self.assertEqual(len(set(map(id, pool.aligned))), 40)
+        self.assertLessEqual(pool.held, 2 * 4 + 4)
+        self.assertGreater(pool.held, 1)
+
+    def test_cache_lookups_per_set(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = ea.PairCache(path, 1 << 24)
+            self.Run(1000, True, (0.1,), cache)
+            self.assertEqual((cache.hits, cache.misses), (0, 40))
+            # The second set is found, after the first is not.
+            cache.misses = 0
+            S, emitted, pool = self.Run(1000, True, (0.0, 0.1), cache)
+            self.assertEqual((cache.hits, cache.misses), (40, 40))
+            self.assertEqual(len(pool.aligned), 40)
+
+
+@unittest.skipIf(ea.np is None, "numpy is not installed")
+class QueryProfileTest(unittest.TestCase):
+
+    def tearDown(self):
+        ea.query_profiles.clear()
+        ea.target_columns.clear()
+
+    def test_cache_is_bounded_by_bytes(self):
+        S = Make_pair("ACGT" * 50, "ACGT" * 50, n_epi=2)
+        params = [Make_param(S)]
+        nbytes = 200 * 16 * 8
+        limit = ea.query_profiles.max_bytes
+        try:
+            ea.query_profiles.max_bytes = 5 * nbytes
+            for k in range(8):
+                ea.Query_profile(S.S1[k:], S.S1_epi[k:], 2, params,
+                                 "float64")
+            self.assertEqual(len(ea.query_profiles.entries), 5)
+            self.assertLessEqual(ea.query_profiles.nbytes, 5 * nbytes)
+            # Too large to be kept.
+            ea.query_profiles.max_bytes = 3 * nbytes
+            ea.query_profiles.clear()
+            ea.Query_profile(S.S1, S.S1_epi, 2, params, "float64")
+            self.assertEqual(len(ea.query_profiles.entries), 0)
+        finally:
+            ea.query_profiles.max_bytes = limit
+
+    def test_target_columns_are_shared(self):
+        S = Make_pair("ACGT", "ACGTTGCA", n_epi=2)
+        S.S2_epi[1] = 3
+        params = [Make_param(S), Make_param(S, Synthetic_model(2, 0.0))]
+        sym2, equil2 = ea.Target_columns(S.S2, S.S2_epi, 2, params,
+                                         "float64")
+        self.assertEqual(sym2.tolist(), [0, 7, 8, 12, 12, 8, 4, 0])
+        self.assertEqual(equil2.shape, (2, 8))
+        self.assertEqual(equil2[1, 1], params[1]['equil_row'][7])
+        self.assertIs(ea.Target_columns(S.S2, S.S2_epi, 2, params,
+                                        "float64")[0], sym2)
+        self.assertFalse(sym2.flags.writeable)
+
+    def test_pairs_grouped_by_the_shared_side(self):
+        S = [Make_pair("ACGT", "ACGTAC"), Make_pair("ACGA", "ACGTAC"),
+             Make_pair("ACGA", "ACGTAC")]
+        self.assertEqual(ea.Group_keys(S, [0, 1, 2]),
+                         {i: ea.Target_key(S[i]) for i in range(3)})
+        self.assertEqual(ea.Group_keys(S, [1, 2]),
+                         {i: ea.Query_key(S[i]) for i in (1, 2)})
+
+
+class PairCacheTest(unittest.TestCase):
+
+    def test_put_evicts_during_a_run(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = ea.PairCache(path, 20000)
+            for k in range(200):
+                cache.put("%064x" % k, (k, [0.0] * 100), False, False)
+                self.assertLessEqual(Directory_size(path), 20000)
+            self.assertGreater(cache.evicted, 0)
+
+    def test_hits_and_misses_per_set(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = ea.PairCache(path, 1 << 20)
+            cache.put("%064x" % 1, (1, []), False, False)
+            for key in ("%064x" % 0, "%064x" % 1):
+                cache.has(key, False, False)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+
+def Shifted_kernel(S, param):
+    '''
+    A kernel backend whose scores are off by one.
+    '''
+    ea.Manhattan(S, param)
+    S.L += 1.0
+    return S
+
+
+class KernelBackendTest(unittest.TestCase):
+
+    NAME = "test_EpiAlignment_3:Shifted_kernel"
+
+    def tearDown(self):
+        ea.KERNELS.pop(self.NAME, None)
+        ea.worker_param = None
+        ea.worker_param_key = None
+
+    def test_registered_and_loaded_kernels(self):
+        S = Make_pair("ACGTTGCA", "GGACGTTGCAGG")
+        param = Make_param(S, kernel="python")
+        records = ea.Kernel_backend("python")(S, [param])
+        shifted = ea.Kernel_backend(self.NAME)(S, [param])
+        self.assertIn(self.NAME, ea.KERNELS)
+        self.assertEqual(shifted[0][0], records[0][0] + 1.0)
+        self.assertEqual(shifted[0][1:], records[0][1:])
+        with self.assertRaises(Exception) as err:
+            ea.Kernel_backend("no_such_kernel")
+        self.assertEqual(err.exception.args[0], 303)
+        with self.assertRaises(Exception) as err:
+            ea.Kernel_backend("test_EpiAlignment_3:No_such_kernel")
+        self.assertEqual(err.exception.args[0], 303)
+
+    @unittest.skipIf(ea.np is None, "numpy is not installed")
+    def test_conformance(self):
+        S = [Make_pair("ACGTTGCA", "GGACGTTGCAGG")]
+        with tempfile.TemporaryDirectory() as path:
+            out = os.path.join(path, "out")
+            err = io.StringIO()
+            with redirect_stderr(err):
+                ea.Conformance(S, 1, Make_param(S[0], window=1000), 30,
+                               1e-6, out, SyncPool())
+            lines = Read(out).splitlines()
+            self.assertEqual(len(lines), 32)
+            self.assertTrue(all(line.endswith("\t1") for line in lines[1:]))
+            with redirect_stderr(err):
+                with self.assertRaises(Exception) as failed:
+                    ea.Conformance(S, 1, Make_param(S[0], kernel=self.NAME,
+                                                    window=1000),
+                                   5, 1e-6, out, SyncPool())
+            self.assertEqual(failed.exception.args[0], 306)
+            self.assertIn("in 6 region pairs", failed.exception.args[1])
+
+
+class ResultWriterTest(unittest.TestCase):
+
+    def test_results_written_and_released_at_once(self):
+        S = [Make_pair("ACGTTGCA", "GGACGTTGCAGG"), Make_pair("ACGA", "TTACG")]
+        with tempfile.TemporaryDirectory() as path:
+            param = Make_param(S[0], kernel="python",
+                               all_prob=os.path.join(path, "vec"))
+            for k, pair in enumerate(S):
+                pair.name = "pair" + str(k)
+                ea.Manhattan(pair, param)
+            prob = list(S[0].prob)
+            out = os.path.join(path, "out")
+            writer = ea.ResultWriter([S], [param], [out])
+            writer.write(0)
+            # Readable before the writer is closed.
+            self.assertEqual(Read(out), ea.Result_line(S[0], param) + "\n")
+            self.assertEqual(Read(param['all_prob']),
+                             ",".join(["pair0"] + [str(f) for f in prob]) +
+                             "\n")
+            self.assertEqual(S[0].prob, [])
+            self.assertNotEqual(S[1].prob, [])
+            writer.write(1)
+            writer.close()
+            self.assertEqual(len(Read(out).splitlines()), 2)
+
+
+@unittest.skipIf(ea.np is None, "numpy is not installed")
+class CheckpointTest(unittest.TestCase):
+
+    def Pairs(self):
+        S = [Make_pair("ACGTTGCA", "GGACGTTGCAGG"),
+             Make_pair("ACGA", "TTACGAT"), Make_pair("TTGCA", "ACGTTGCA")]
+        for k, pair in enumerate(S):
+            pair.name = "pair" + str(k)
+        return S
+
+    def Resume(self, ckpt, digest, S):
+        out = ckpt + ".out"
+        writer = ea.ResultWriter([S], [Make_param(S[0])], [out])
+        err = io.StringIO()
+        with redirect_stderr(err):
+            n_done = ea.Open_checkpoint(ckpt, digest, [S], writer, True)
+        writer.close()
+        with open(out) as fin:
+            return n_done, fin.read(), err.getvalue()
+
+    def test_resume_after_a_record_cut_short(self):
+        with tempfile.TemporaryDirectory() as path:
+            ckpt = os.path.join(path, "ckpt")
+            S = self.Pairs()
+            param = Make_param(S[0])
+            for pair in S:
+                ea.Manhattan_np(pair, param)
+            writer = ea.ResultWriter([S], [param], [ckpt + ".first"])
+            ea.Open_checkpoint(ckpt, "digest", [S], writer, False)
+            for i in range(3):
+                writer.write(i)
+            writer.close()
+            n_done, out, err = self.Resume(ckpt, "digest", self.Pairs())
+            self.assertEqual((n_done, err), (3, ""))
+            with open(ckpt + ".first") as fin:
+                self.assertEqual(out, fin.read())
+            with open(ckpt, "r+b") as fout:
+                fout.truncate(os.path.getsize(ckpt) - 5)
+            n_done, out, err = self.Resume(ckpt, "digest", self.Pairs())
+            self.assertEqual(n_done, 2)
+            self.assertIn("incomplete after 2 region pairs", err)
+            # The record cut short was removed from the checkpoint.
+            self.assertEqual(self.Resume(ckpt, "digest", self.Pairs())[:1],
+                             (2,))
+
+    def test_checkpoint_started_over(self):
+        with tempfile.TemporaryDirectory() as path:
+            ckpt = os.path.join(path, "ckpt")
+            self.Resume(ckpt, "digest", self.Pairs())
+            n_done, out, err = self.Resume(ckpt, "other", self.Pairs())
+            self.assertEqual((n_done, out), (0, ""))
+            self.assertIn("another input", err)
+            with open(ckpt, "wb") as fout:
+                fout.write(b"not a checkpoint")
+            n_done, out, err = self.Resume(ckpt, "other", self.Pairs())
+            self.assertEqual(n_done, 0)
+            self.assertIn("could not be read", err)
+
+
+class ForwardTest(unittest.TestCase):
+
+    def test_service_closed_without_a_reply(self):
+        with tempfile.TemporaryDirectory() as path:
+            address = os.path.join(path, "socket")
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(address)
+            server.listen(1)
+
+            def Close():
+                conn, addr = server.accept()
+                conn.makefile("rb").readline()
+                conn.close()
+
+            thread = threading.Thread(target=Close)
+            thread.start()
+            err = io.StringIO()
+            with redirect_stderr(err):
+                self.assertFalse(ea.Forward(address))
+            thread.join()
+            server.close()
+            self.assertIn("without a reply", err.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+'''
+Tests of ScoreVectors.py. Run with: python -m pytest test_ScoreVectors.py
+'''
+import io
+import os
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+import ScoreVectors as sv
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class RoundTripTest(unittest.TestCase):
+
+    VECTORS = [("pair0", [0.5, -1.25, float('-Inf')]), ("pair1", []),
+               ("région 2", [1e-3] * 7)]
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.dir.name, "vec")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def Write(self, vectors):
+        writer = sv.VectorWriter(self.fname)
+        for name, scores in vectors:
+            writer.write(name, scores)
+        writer.close()
+
+    def test_vectors_read_back(self):
+        self.Write(self.VECTORS)
+        store = sv.ScoreVectors(self.fname)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.names, [v[0] for v in self.VECTORS])
+        for k, (name, scores) in enumerate(self.VECTORS):
+            self.assertEqual(store[k].dtype, np.dtype("<f4"))
+            self.assertEqual(store[k].tolist(),
+                             np.array(scores, dtype=np.float32).tolist())
+        self.assertFalse(store[0].flags.writeable)
+
+    def test_empty_store(self):
+        self.Write([])
+        self.assertEqual(len(sv.ScoreVectors(self.fname)), 0)
+
+    def test_incomplete_store(self):
+        writer = sv.VectorWriter(self.fname)
+        writer.write("pair0", [1.0] * 10)
+        writer.flush()
+        with self.assertRaises(ValueError):
+            sv.ScoreVectors(self.fname)
+        writer.close()
+        self.assertEqual(len(sv.ScoreVectors(self.fname)), 1)
+
+    def test_text_conversion(self):
+        self.Write(self.VECTORS[:2])
+        out = io.StringIO()
+        argv = sys.argv
+        try:
+            sys.argv = ["ScoreVectors.py", self.fname]
+            with redirect_stdout(out):
+                sv.Main()
+        finally:
+            sys.argv = argv
+        self.assertEqual(out.getvalue(), "pair0,0.5,-1.25,-inf\npair1\n")
+
+
+if __name__ == "__main__":
+    unittest.main()